@@ -0,0 +1,55 @@
+# abel.py
+# Inverse Abel transform for axisymmetric flows by onion peeling (Dasch 1992).
+# A projection row P(y) through rings of constant f(r) is P = dr * W f, with W
+# the chord lengths of each ring. The inverse operator D = W^-1 depends only on
+# the number of radial samples, so it is built once per (width, axis,
+# downsample) and every frame is one matrix multiply over all its rows:
+#   field = abel.invert(diff, axis_x=320, ds=2)
+import functools
+import cv2
+import numpy as np
+
+@functools.lru_cache(maxsize=8)
+def onion_matrix(n):
+    """D = W^-1 for n radial samples (float64), with W in units of dr."""
+    i = np.arange(n, dtype=np.float64)[:, None]; j = np.arange(n, dtype=np.float64)[None, :]
+    outer = np.sqrt(np.maximum((2 * j + 1) ** 2 - 4 * i ** 2, 0))
+    inner = np.sqrt(np.maximum((2 * j - 1) ** 2 - 4 * i ** 2, 0))
+    W = np.where(j > i, outer - inner, 0.0) + np.where(j == i, outer, 0.0)
+    return np.linalg.inv(W)
+
+@functools.lru_cache(maxsize=16)
+def operator(width, axis, ds=1):
+    """Everything invert() needs for rows of `width` (after downsampling by ds)
+    about column `axis`: (D^T, right and left gather indices, 1 / samples per
+    radius, output column -> radius)."""
+    n = max(axis + 1, width - axis)
+    r = np.arange(n)
+    # Index `width` is a zero column appended to the row
+    right = np.where(axis + r < width, axis + r, width)
+    left = np.where(axis - r >= 0, axis - r, width)
+    count = (axis + r < width).astype(np.float32) + (axis - r >= 0)
+    DT = (onion_matrix(n).T / ds).astype(np.float32)
+    return DT, right, left, (1.0 / count).astype(np.float32), np.abs(np.arange(width) - axis)
+
+def invert(img, axis_x, ds=1):
+    """Radial field f(r) of every row of img about column axis_x.
+
+    Both sides of the axis are averaged into one symmetric profile per row.
+    Returns float32 of the (downsampled) image size with f(|x - axis|) in each
+    column, in input units per pixel of path length.
+    """
+    img = np.asarray(img, np.float32)
+    if ds > 1: img = cv2.resize(img, (img.shape[1] // ds, img.shape[0] // ds), interpolation=cv2.INTER_AREA)
+    h, w = img.shape
+    axis = min(max(int(axis_x) // ds, 0), w - 1)
+    DT, right, left, inv_count, out_cols = operator(w, axis, ds)
+    src = cv2.copyMakeBorder(img, 0, 0, 0, 1, cv2.BORDER_CONSTANT, value=0)
+    P = (src[:, right] + src[:, left]) * inv_count
+    return np.take(P @ DT, out_cols, axis=1)
+
+def forward(field, ds=1):
+    """Projection of radial profiles (rows of f(r), r = 0..n-1): the inverse of
+    the onion operator. For tests and for synthesizing projections."""
+    n = field.shape[-1]
+    return np.asarray(field, np.float64) @ np.linalg.inv(onion_matrix(n)).T * ds
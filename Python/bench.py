@@ -0,0 +1,229 @@
+# bench.py
+# Throughput benchmarks on simulated camera and pigpio backends (see fakes.py),
+# so they run on any Linux box:
+#   python bench.py                      # all cases, results to bench.json
+#   python bench.py --quick --only process
+#   python bench.py --baseline old.json  # compare against an earlier run
+# importtime/* and startup/* run in fresh interpreters: -X importtime cumulative
+# import cost per module, and main.py's time to the first preview frame (needs a display).
+import argparse
+import atexit
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import fakes
+fakes.install()
+
+import cv2
+import abel
+import camera
+import hardware
+import processor
+import scan
+import videostream
+
+MODES = ["Raw", "Abs Diff (B/W)", "Enhanced", "Colorize", "Heatmap (Jet)", "Heatmap (Inferno)"]
+SIZES = [(640, 480), (1440, 1080)]
+MODES_3D = ["Topography", "Stacked Slices", "Revolution"]
+
+SCAN_PARAMS = dict(v_trig_fps=20, v_ctx=True, v_exp=10, v_led=10, v_gain_ana=4.0, v_delay=1000,
+                   v_start=1000, v_end=1400, v_step=100, v_freq=40000, v_cycles=100, v_stack=4,
+                   v_save_raw=True, v_gx=3, v_gy=0, v_gamp=0.2, v_gain_dig=25.0, v_mode="Colorize",
+                   v_video_fps=15, v_sequencer=False)
+
+def frames(size, delay=1000):
+    w, h = size
+    scene = fakes.Picamera2.scene
+    return scene.frame(h, w, True, delay, 0), scene.frame(h, w, False, delay, 1)
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup): fn()
+    t = []
+    for _ in range(repeat):
+        t0 = time.perf_counter(); fn(); t.append(time.perf_counter() - t0)
+    t = np.array(t) * 1000.0
+    return {"median_ms": float(np.median(t)), "min_ms": float(t.min()), "max_ms": float(t.max()), "n": repeat}
+
+def cases(quick):
+    """(name, function, repeat) for every benchmark."""
+    r = 3 if quick else 10
+    sizes = SIZES[:1] if quick else SIZES
+    for size in sizes:
+        sig, bg = frames(size)
+        tag = f"{size[0]}x{size[1]}"
+        proc = processor.FrameProcessor()
+        for mode in MODES:
+            yield f"process_frame/{mode}/{tag}", lambda m=mode, s=sig, b=bg: processor.process_frame(s, b, 25.0, m, (3, 0, 0.2)), r
+            yield f"FrameProcessor/{mode}/{tag}", lambda m=mode, s=sig, b=bg, p=proc: p.process(s, b, 25.0, m, (3, 0, 0.2)), r
+
+    for fmt in ("RGB888", "YUV420"):
+        yield f"capture_stack/{fmt}/1440x1080", _capture_case(fmt, True), r * 2
+        yield f"capture_copy/{fmt}/1440x1080", _capture_case(fmt, False), r * 2
+
+    sig, bg = frames(SIZES[0])
+    diff = sig.astype(np.float32) - bg
+    for ds in (1, 2):
+        yield f"abel_invert/ds{ds}/640x480", lambda d=ds: abel.invert(diff, 320, d), r * 2
+    shown = processor.FrameProcessor().process(sig, bg, 25.0, "Colorize", (3, 0, 0.2)).copy()
+    yield "create_histogram/640x480", lambda: processor.create_histogram(shown), r * 5
+    overlay = processor.HistogramOverlay(rate_hz=0)
+    yield "HistogramOverlay/640x480", lambda: overlay.update(shown, sig) and overlay.draw(shown), r * 5
+
+    # Sensor noise makes every quad of the 3D surface a spike: the slow case for the rasterizer
+    noisy = np.clip(sig + np.random.default_rng(0).normal(0, 6, sig.shape), 0, 255).astype(np.uint8)
+    textured = processor.FrameProcessor().process(noisy, bg, 25.0, "Colorize", (3, 0, 0.2)).copy()
+    for mode in MODES_3D:
+        yield f"render_3d_frame/{mode}/quality", lambda m=mode: processor.render_3d_frame(shown, mode=m), max(2, r // 3)
+        yield f"render_3d_frame/{mode}/fast", lambda m=mode: processor.render_3d_frame(shown, mode=m, quality=False), r
+        yield f"render_3d_frame/{mode}/fast_textured", lambda m=mode: processor.render_3d_frame(textured, mode=m, quality=False), r
+
+    yield "generate_video/2d/30", _video_case(shown, 30), max(2, r // 3)
+    yield "videostream/2d/30", _stream_case(shown, 30), max(2, r // 3)
+
+    for cycles in (1, 10, 50, 100):
+        key = hardware.HardwareManager.wave_key(1000, 10, 10, 40000, cycles, 20, True, True, True)
+        yield f"build_pulses/cycles{cycles}", lambda k=key: hardware.HardwareManager.wave_pulses(k), r * 10
+        yield f"build_pulses_reference/cycles{cycles}", \
+            lambda k=key: hardware.HardwareManager.wave_pulses(k, builder=hardware.HardwareManager._build_pulses_reference), r * 10
+
+    yield "scan/simulated", _scan_case(), 1
+
+    for mod in ("processor", "scan", "main"):
+        yield f"importtime/{mod}", _import_case(mod), max(2, r // 3)
+    yield "startup/first_frame", _first_frame_case, max(2, r // 3)
+
+def sample(fn, repeat, warmup=0):
+    """Like measure() for cases that report their own duration (ms)."""
+    t = np.array([fn() for _ in range(repeat)])
+    return {"median_ms": float(np.median(t)), "min_ms": float(t.min()), "max_ms": float(t.max()), "n": repeat}
+
+def _python(code, *flags):
+    here = os.path.dirname(os.path.abspath(__file__))
+    res = subprocess.run([sys.executable, *flags, "-c", code], cwd=here, capture_output=True, text=True, timeout=120)
+    if res.returncode: raise RuntimeError(res.stderr.strip().splitlines()[-1])
+    return res
+
+def _import_case(mod):
+    # The simulated devices are registered first (numpy is already loaded by then)
+    def run():
+        res = _python(f"import fakes; fakes.install(); import {mod}", "-X", "importtime")
+        for line in res.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[2][1:] == mod: return int(parts[1]) / 1000.0
+        raise RuntimeError(f"{mod} not in importtime output")
+    return run
+
+_FIRST_FRAME = """import fakes; fakes.install()
+import tkinter as tk, main
+root = tk.Tk(); app = main.CameraApp(root)
+def poll():
+    if app.first_frame_s is None: root.after(5, poll); return
+    print(app.first_frame_s); app.on_close()
+root.after(5, poll); root.mainloop()"""
+
+def _first_frame_case():
+    return float(_python(_FIRST_FRAME).stdout.strip().splitlines()[-1]) * 1000.0
+
+class _BufferCamera:
+    """Hands out one ready buffer the way picamera2 does: capture_array copies it,
+    a mapped request does not. Isolates the host-side cost of each format."""
+    def __init__(self, fmt, size):
+        cam = fakes.Picamera2(); cam.configure({"main": {"size": size, "format": fmt}})
+        self.buf = cam.capture_array()
+    def capture_array(self, name="main"): return self.buf.copy()
+    def capture_request(self): return fakes.FakeRequest(self.buf)
+
+def _capture_case(fmt, stack, size=(1440, 1080)):
+    """One frame into the stack accumulator (scan) or out as a gray copy (preview)."""
+    cam = _BufferCamera(fmt, size)
+    acc = processor.StackAccumulator()
+    luma = fmt == "YUV420"
+    def run():
+        # Later cases run in the configured capture mode, whatever this one used
+        old = camera.LUMA; camera.LUMA = luma
+        try:
+            if stack: camera.capture(cam, size, acc.add)
+            else:
+                frame = camera.capture(cam, size)
+                if frame.ndim == 3: cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        finally: camera.LUMA = old
+    return run
+
+def _video_case(img, n):
+    folder = tempfile.mkdtemp(prefix="bench_video_")
+    atexit.register(shutil.rmtree, folder, True)
+    for i in range(n): cv2.imwrite(os.path.join(folder, f"frame_{i:05d}.png"), img)
+    return lambda: processor.generate_video(folder, fps=15)
+
+def _stream_case(img, n):
+    folder = tempfile.mkdtemp(prefix="bench_stream_")
+    atexit.register(shutil.rmtree, folder, True)
+    def run():
+        stream = videostream.VideoStream(os.path.join(folder, "output_2d.avi"), 15)
+        for i in reversed(range(n)): stream.put(i, img)
+        stream.close()
+    return run
+
+def _scan_case():
+    def run():
+        cwd = os.getcwd(); tmp = tempfile.mkdtemp(prefix="bench_scan_")
+        hw = hardware.HardwareManager()
+        try:
+            os.chdir(tmp)
+            scan.ScanEngine(hw, dict(SCAN_PARAMS), status=lambda s: None).run(False)
+        finally:
+            os.chdir(cwd); hw.cleanup(); shutil.rmtree(tmp, ignore_errors=True)
+    return run
+
+def compare(results, baseline, tolerance):
+    """Prints new vs baseline medians; returns the names that got slower than tolerance."""
+    slower = []
+    print(f"\n{'case':48s} {'ms':>9s} {'base':>9s} {'ratio':>6s}")
+    for name, r in results.items():
+        b = baseline.get("results", {}).get(name)
+        if not b: print(f"{name:48s} {r['median_ms']:9.2f} {'-':>9s}"); continue
+        ratio = r["median_ms"] / max(b["median_ms"], 1e-9)
+        flag = " SLOWER" if ratio > 1 + tolerance else (" faster" if ratio < 1 - tolerance else "")
+        if ratio > 1 + tolerance: slower.append(name)
+        print(f"{name:48s} {r['median_ms']:9.2f} {b['median_ms']:9.2f} {ratio:6.2f}{flag}")
+    return slower
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Schlieren rig benchmarks on simulated hardware")
+    ap.add_argument("--quick", action="store_true", help="640x480 only, fewer repeats")
+    ap.add_argument("--only", action="append", help="glob on case names (repeatable), e.g. 'process*'")
+    ap.add_argument("--out", default="bench.json")
+    ap.add_argument("--baseline", help="earlier bench.json to compare against")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="ratio change reported as slower/faster")
+    ap.add_argument("--strict", action="store_true", help="exit 1 if any case is slower than the baseline")
+    args = ap.parse_args(argv)
+
+    results = {}
+    for name, fn, repeat in cases(args.quick):
+        if args.only and not any(fnmatch.fnmatch(name, p) or p in name for p in args.only): continue
+        timer = sample if name.startswith(("importtime/", "startup/")) else measure
+        try: results[name] = timer(fn, repeat, warmup=0 if name.startswith("scan/") else 1)
+        except Exception as e: print(f"{name}: Error: {e}"); continue
+        print(f"{name:48s} {results[name]['median_ms']:9.2f} ms")
+
+    data = {"meta": {"time": time.strftime('%Y-%m-%d %H:%M:%S'), "python": sys.version.split()[0],
+                     "numpy": np.__version__, "opencv": cv2.__version__, "machine": platform.machine(),
+                     "processor": platform.processor(), "cpus": os.cpu_count(), "quick": args.quick},
+            "results": results}
+    with open(args.out, "w") as f: json.dump(data, f, indent=1)
+    print(f"Saved {args.out}")
+
+    if args.baseline:
+        with open(args.baseline) as f: slower = compare(results, json.load(f), args.tolerance)
+        if slower and args.strict: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# camera.py
+# Camera configuration and capture shared by the preview and the scan.
+# With config.CAPTURE_FORMAT = "YUV420" frames are taken as the Y (luma) plane
+# of the ISP output: 1 byte per pixel instead of 3 and no RGB->gray conversion.
+import contextlib
+import threading
+import time
+from picamera2 import MappedArray, Picamera2
+
+import config
+import perf
+
+LUMA = config.CAPTURE_FORMAT in ("YUV420", "YVU420")
+PREVIEW_SIZE = (640, 480)
+SCAN_SIZE = (1440, 1080)
+
+def video_config(cam, size):
+    return cam.create_video_configuration(main={"size": size, "format": config.CAPTURE_FORMAT})
+
+def sensor_clock_ns():
+    """Now on the clock SensorTimestamp uses (CLOCK_BOOTTIME)."""
+    return time.clock_gettime_ns(time.CLOCK_BOOTTIME)
+
+def roi_rect(size, roi):
+    """Pixel (x, y, w, h) of a roi given as fractions of a frame of `size`,
+    aligned for the ISP: width to 32 px, everything else to 2 px."""
+    W, H = size; fx, fy, fw, fh = roi
+    w = min(W, max(32, int(round(fw * W / 32)) * 32)); h = min(H, max(2, int(round(fh * H / 2)) * 2))
+    x = min(W - w, max(0, int(fx * W) // 2 * 2)); y = min(H - h, max(0, int(fy * H) // 2 * 2))
+    return x, y, w, h
+
+def roi_within(size, roi, outer=None):
+    """Pixel (x, y, w, h) of roi (fractions of a full frame of `size`) within the
+    frame delivered for the capture ROI `outer`, or None if they don't overlap."""
+    W, H = size; fx, fy, fw, fh = roi
+    ox, oy, ow, oh = roi_rect(size, outer) if outer else (0, 0, W, H)
+    x0 = max(ox, int(fx * W)); y0 = max(oy, int(fy * H))
+    x1 = min(ox + ow, int((fx + fw) * W)); y1 = min(oy + oh, int((fy + fh) * H))
+    if x1 - x0 < 2 or y1 - y0 < 2: return None
+    return x0 - ox, y0 - oy, x1 - x0, y1 - y0
+
+def _view(f, crop):
+    if crop is None: return f
+    x, y, w, h = crop
+    return f[y:y+h, x:x+w]
+
+@contextlib.contextmanager
+def frame(cam, size, crop=None):
+    """(frame, metadata) of the next request, cut to crop (x, y, w, h) if given.
+    In luma mode frame is the Y plane as a view into the camera buffer, valid
+    only inside the with block."""
+    req = cam.capture_request()
+    try:
+        md = req.get_metadata()
+        if not LUMA:
+            yield _view(req.make_array("main"), crop), md
+        else:
+            w, h = size
+            with MappedArray(req, "main") as m:
+                # Buffer is (h * 3 / 2, stride): Y rows first, then U and V
+                yield _view(m.array[:h, :w], crop), md
+    finally:
+        req.release()
+
+def capture(cam, size, consume=None, crop=None):
+    """Next frame as a 2D luma array (YUV420) or an RGB888 array.
+
+    With consume, it is called on the frame and its result returned; in luma
+    mode the frame is then a view straight into the camera buffer, valid only
+    during the call, so nothing is copied at all. Without consume the Y plane
+    is copied out (1 byte per pixel) so the caller may keep it.
+    """
+    with frame(cam, size, crop) as (f, _):
+        if consume: return consume(f)
+        return f.copy() if LUMA else f
+
+def discard(cam, n=1):
+    """Drops n frames without mapping or copying them."""
+    for _ in range(n): cam.capture_request().release()
+
+class CameraManager:
+    """Owns the one Picamera2 for the whole session.
+
+    Configurations are created once per stream size. use() switches between
+    modes: it reconfigures only when the stream size changes and otherwise just
+    applies new controls. Settling is taken from frame metadata (the exposure
+    and gain the sensor actually applied) instead of fixed sleeps.
+
+    With a region of interest (set_roi) the context and scan modes deliver only
+    that part of the frame: the ISP crops it (ScalerCrop) into a smaller output
+    at the same scale, or, without ScalerCrop, frames are cut to the `crop`
+    view. Readers pass `size` and `crop` on to frame()/capture().
+    """
+    SIZES = {"preview": PREVIEW_SIZE, "context": SCAN_SIZE, "scan": SCAN_SIZE}
+    ROI_MODES = ("context", "scan")
+
+    def __init__(self):
+        self.cam = Picamera2()
+        self.configs = {size: video_config(self.cam, size) for size in set(self.SIZES.values())}
+        self.lock = threading.RLock()
+        self.mode = None
+        self.size = None
+        self.crop = None
+        self.controls = {}
+        self.roi = None
+        self.scaler_crop = None
+
+    def set_roi(self, roi):
+        """roi is (x, y, w, h) as fractions of the full frame, or None for all of
+        it. Takes effect on the next use() of a context or scan mode."""
+        with self.lock: self.roi = tuple(roi) if roi else None
+
+    def use(self, mode, controls=None, settle=True):
+        """Switch to `mode` with `controls` applied; returns the Picamera2."""
+        with self.lock:
+            full = self.SIZES[mode]
+            roi = self.roi if mode in self.ROI_MODES else None
+            rect = roi_rect(full, roi) if roi else None
+            isp = rect is not None and "ScalerCrop" in self.cam.camera_controls
+            size = rect[2:] if isp else full
+            if size != self.size:
+                if self.mode is not None: self.cam.stop()
+                if size not in self.configs: self.configs[size] = video_config(self.cam, size)
+                self.cam.configure(self.configs[size])
+                self.cam.start()
+                self.size = size
+                self.controls = {}; self.scaler_crop = None
+            self.crop = rect if rect and not isp else None
+            self._scaler_crop(rect if isp else None, full)
+            self.mode = mode
+            if controls: self.set_controls(controls, settle)
+            return self.cam
+
+    def _scaler_crop(self, rect, full):
+        """Points the ISP crop at rect (pixels of a `full`-size frame), or the whole sensor."""
+        if rect == self.scaler_crop or "ScalerCrop" not in self.cam.camera_controls: return
+        mx, my, mw, mh = self.cam.camera_controls["ScalerCrop"][1]
+        if rect is None: crop = (mx, my, mw, mh)
+        else:
+            x, y, w, h = rect; fw, fh = full
+            crop = (mx + x * mw // fw, my + y * mh // fh, w * mw // fw, h * mh // fh)
+        self.cam.set_controls({"ScalerCrop": crop})
+        self.scaler_crop = rect
+
+    def set_controls(self, controls, settle=True):
+        changed = {k: v for k, v in controls.items() if self.controls.get(k) != v}
+        if not changed: return 0
+        self.cam.set_controls(changed)
+        self.controls.update(changed)
+        return self.settle() if settle else 0
+
+    def settle(self, timeout=config.CAMERA_SETTLE_S):
+        """Drops frames until their metadata shows the requested exposure and
+        gain. Returns the number of frames dropped."""
+        exp = self.controls.get("ExposureTime"); gain = self.controls.get("AnalogueGain")
+        end = time.monotonic() + timeout; n = 0
+        while time.monotonic() < end:
+            md = self.cam.capture_metadata(); n += 1
+            # Exposure is quantized to sensor lines, gain to register steps
+            ok_exp = exp is None or abs(md.get("ExposureTime", exp) - exp) <= max(30, 0.02 * exp)
+            ok_gain = gain is None or abs(md.get("AnalogueGain", gain) - gain) <= 0.05 * gain
+            if ok_exp and ok_gain: return n
+        print(f"Camera did not settle on {self.controls} within {timeout}s")
+        return n
+
+    def close(self):
+        with self.lock:
+            try: self.cam.stop(); self.cam.close()
+            except: pass
+            self.mode = self.size = None
+
+class FramePairer:
+    """Places the frames of an interleaved wave into slots by SensorTimestamp.
+
+    Slot 2k is the signal frame of wave period k and 2k+1 its background
+    frame. The signal pass is shorter than the background pass (see
+    HardwareManager.wave_timing), so the interval between the first two frames
+    fixes the phase. After that each frame is matched to the nearest expected
+    slot, which also follows slow drift between the camera and pigpio clocks.
+    Frames from before since_ns (a previous wave), off the wave's timing or
+    repeating a slot are rejected; slots with no frame count as dropped. When
+    since_ns is when the wave was started, slots count from its first period.
+    shift(k) optionally gives a known trigger offset in ns for period k, e.g.
+    the delay change between the waves of a chained sweep.
+    """
+    def __init__(self, timing, since_ns=0, tol_us=config.PAIR_TOL_US, shift=None):
+        sig_us, bg_us = timing
+        self.sig = sig_us * 1000
+        self.period = (sig_us + bg_us) * 1000
+        self.tol = min(tol_us, (bg_us - sig_us) // 2 - 1) * 1000
+        self.since = since_ns
+        self.shift = shift or (lambda k: 0)
+        self.ref = None     # signal timestamp of period 0, less its shift
+        self.first = None
+        self.last = -1
+        self.rejected = 0
+        self.dropped = 0
+
+    def _match(self, ts):
+        base = (ts - self.ref) // self.period
+        best = None
+        for k in (base - 1, base, base + 1):
+            if k < 0: continue
+            t = self.ref + k * self.period + self.shift(k)
+            for slot, err in ((2 * k, ts - t), (2 * k + 1, ts - t - self.sig)):
+                if abs(err) <= self.tol and (best is None or abs(err) < abs(best[1])): best = (slot, err)
+        return best
+
+    def add(self, ts):
+        """Slots resolved by the frame at ts: [] while the phase is still unknown
+        (keep the frame, it is resolved with the next one), [(ts, slot), ...]
+        once known, or None if the frame is rejected."""
+        if ts < self.since: self.rejected += 1; return None
+        if self.ref is None:
+            if self.first is None: self.first = ts; return []
+            t1, self.first = self.first, None
+            m = (ts - t1) % self.period
+            if abs(m - self.sig) <= self.tol: phase = 0
+            elif abs(m - (self.period - self.sig)) <= self.tol: phase = 1
+            else:
+                # Can't tell the phase from this interval: retry from this frame
+                self.rejected += 1; self.first = ts; return []
+            # Period of the first frame, counted from since_ns (the wave start when known)
+            k = (t1 - self.since) // self.period
+            k = max(0, (t1 - self.since - self.shift(k)) // self.period)
+            self.ref = t1 - k * self.period - self.shift(k) - phase * self.sig
+            self.last = 2 * k + phase
+            out = [(t1, self.last)]
+        else: out = []
+        hit = self._match(ts)
+        if hit is None or hit[0] <= self.last:
+            self.rejected += 1
+            return out or None
+        slot, err = hit
+        self.dropped += slot - self.last - 1
+        self.last = slot
+        self.ref += err
+        return out + [(ts, slot)]
+
+def placed_frames(cam, size, pairer_at, crop=None):
+    """(slot, frame) for every capture, or (None, None) for one no FramePairer
+    could place. pairer_at(ts) gives the (pairer, first slot) responsible for a
+    SensorTimestamp. Frames are views into camera buffers in luma mode, valid
+    until the next item is taken; only a frame held to fix the phase is copied.
+    """
+    held = None; current = None
+    while True:
+        t = time.perf_counter()
+        with frame(cam, size, crop) as (f, md):
+            ts = md.get("SensorTimestamp", 0)
+            pairer, base = pairer_at(ts)
+            if pairer is not current: current = pairer; held = None
+            placed = pairer.add(ts)
+            # "capture" covers the wait and the placement only, not the consumer's work between yields
+            perf.record("capture", time.perf_counter() - t)
+            if not placed:
+                if placed is not None: held = (ts, f.copy())
+                yield None, None; continue
+            for t, slot in placed: yield base + slot, (held[1] if held and t == held[0] else f)
+            held = None
+
+def frame_pairs(cam, size, pairer):
+    """For each frame taken: a (signal, background) copy once both frames of
+    one wave period are in, else None. Periods missing either are skipped."""
+    sig = None
+    for slot, f in placed_frames(cam, size, lambda ts: (pairer, 0)):
+        if slot is None: yield None
+        elif not slot & 1: sig = (slot, f.copy()); yield None
+        elif sig and sig[0] == slot - 1: yield sig[1], f.copy(); sig = None
+        else: yield None
@@ -20,6 +20,61 @@ DEFAULT_START = 1000
 DEFAULT_END = 1002
 DEFAULT_STEP = 1
 DEFAULT_STACK = 20
+# Adaptive stacking: stop a delay once the ROI noise of the stacked difference
+# is below DEFAULT_NOISE_TARGET (DN, before Dig Gain), after at least DEFAULT_STACK_MIN pairs
+DEFAULT_STACK_MIN = 4
+DEFAULT_NOISE_TARGET = 0.5
 
 # Timing padding
 WAVE_PADDING_US = 50000
+
+# pigpio wave resources (WAVE_MAX_CBS is used if the daemon can't be queried)
+WAVE_MAX_IDS = 250
+WAVE_MAX_CBS = 25016
+WAVE_MAX_PULSES = 12000
+# Check every new wave against the reference pulse builder (slow, for debugging)
+PULSE_VERIFY = False
+# Carrier cycles from which _build_pulses compiles with NumPy (measured parity ~800-1000 cycles at 40 kHz)
+PULSE_NUMPY_MIN_CYCLES = 1000
+# wave_chain limits for the whole-sweep sequencer (longer sweeps are split into segments)
+WAVE_CHAIN_MAX_BYTES = 600
+WAVE_CHAIN_MAX_LOOPS = 10
+# Upcoming delays whose waves are created ahead of time during a scan
+WAVE_PREFETCH = 4
+
+# Scan pipeline: processing workers and max delays buffered ahead of them
+SCAN_WORKERS = 2
+SCAN_QUEUE_DEPTH = 2
+
+# Preview histogram: redraw rate and pixel stride of the sampled view
+HIST_RATE_HZ = 5
+HIST_STRIDE = 4
+
+# Timing probes (perf.py): samples kept per stage
+PERF_RING_SIZE = 512
+
+# Camera stream format: "YUV420" captures the luma plane only, "RGB888" full colour
+CAPTURE_FORMAT = "YUV420"
+
+# Longest wait for the camera to report newly requested exposure/gain
+CAMERA_SETTLE_S = 1.0
+
+# Interleaved waves: the background pass runs this much longer than half the
+# trigger period and the signal pass this much shorter, so frame timestamps
+# identify the phase. Timestamps within PAIR_TOL_US of the expected slot pair up.
+PHASE_MARK_US = 2000
+PAIR_TOL_US = 1000
+# Frames queued from the previous wave are at least its 2 ms end padding older
+# than a wave switch; frames from before (switch seen - PAIR_STALE_US) are dropped
+PAIR_STALE_US = 1000
+
+# Scan video: frames buffered ahead of the encoder thread, and whether to also
+# write a lossless FFV1 .mkv through ffmpeg (when installed)
+VIDEO_QUEUE_DEPTH = 8
+VIDEO_FFV1 = False
+
+# Lock-in maps at the end of a scan: harmonics of the drive frequency to demodulate
+LOCKIN_HARMONICS = (1,)
+
+# Abel inversion: downsample factor of the inversion grid (operator is cached per size)
+ABEL_DS = 2
@@ -0,0 +1,153 @@
+# experiment.py
+# Batch runner for multi-parameter scans. A plan is JSON with the settings-file
+# keys (v_freq, v_cycles, v_gain_ana, ...):
+#   {"name": "transducer_a",
+#    "base":  {"v_start": 900, "v_end": 1100, "v_step": 10},
+#    "sweep": {"v_freq": [38000, 40000, 42000], "v_gain_ana": [4.0, 8.0]},
+#    "runs":  [{"v_cycles": 10}, {"v_cycles": 50}]}
+# Every listed run is combined with every point of the Cartesian sweep, on top
+# of base (itself on top of the current settings). Runs are ordered so the
+# expensive changes happen least often: camera settings first, then wave
+# parameters. Finished runs are recorded in progress.json, so an interrupted
+# plan picks up where it stopped:
+#   python experiment.py plan.json [--settings saved.json] [--dry-run]
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import shutil
+
+# Reconfiguration cost tiers. Camera: ROI (stream reconfigure), analog gain and
+# exposure (settling), FPS (context exposure). Waves: everything the
+# HardwareManager wave key and the delay list are built from.
+CAMERA_KEYS = ("v_roi", "v_gain_ana", "v_exp", "v_trig_fps")
+WAVE_KEYS = ("v_freq", "v_cycles", "v_led", "v_start", "v_end", "v_step", "v_delay")
+PROGRESS_FILE = "progress.json"
+
+def expand(plan):
+    """Override dicts, one per run, in plan order."""
+    sweep = plan.get("sweep", {})
+    keys = sorted(sweep)
+    grid = [dict(zip(keys, values)) for values in itertools.product(*(sweep[k] for k in keys))]
+    return [{**run, **point} for run in plan.get("runs", [{}]) for point in grid]
+
+def _sort_value(v):
+    # Lists (ROI) and None sort alongside numbers without comparing mixed types
+    return (v is not None, json.dumps(v, sort_keys=True) if isinstance(v, (list, dict, str)) else v)
+
+def cost_key(params, point):
+    tier = lambda keys: tuple(_sort_value(params.get(k)) for k in keys)
+    rest = sorted(k for k in point if k not in CAMERA_KEYS + WAVE_KEYS)
+    return tier(CAMERA_KEYS), tier(WAVE_KEYS), tuple(_sort_value(point[k]) for k in rest)
+
+def point_id(point):
+    return hashlib.sha1(json.dumps(point, sort_keys=True).encode()).hexdigest()[:10]
+
+def point_label(point):
+    text = "_".join(f"{k[2:] if k.startswith('v_') else k}{v}" for k, v in sorted(point.items()) if k != "v_roi")
+    return "".join(c if c.isalnum() or c in "._-" else "-" for c in text)[:80] or "run"
+
+class Experiment:
+    """An expanded, ordered plan plus its checkpoint in `folder`.
+
+    settings are the defaults under the plan's base (the UI's current values,
+    or a saved settings file when headless).
+    """
+    def __init__(self, plan, settings=None, folder=None):
+        self.plan = plan
+        self.folder = folder or os.path.join("experiments", plan.get("name", "experiment"))
+        base = {**(settings or {}), **plan.get("base", {})}
+        points = expand(plan)
+        runs = [({**base, **pt}, pt) for pt in points]
+        runs.sort(key=lambda r: cost_key(*r))
+        self.runs = runs
+        self.done = self.load_progress()
+
+    def load_progress(self):
+        path = os.path.join(self.folder, PROGRESS_FILE)
+        if not os.path.exists(path): return {}
+        try:
+            with open(path) as f: return json.load(f).get("done", {})
+        except Exception as e: print(f"Progress Error: {e}"); return {}
+
+    def save_progress(self):
+        if not os.path.exists(self.folder): os.makedirs(self.folder)
+        path = os.path.join(self.folder, PROGRESS_FILE)
+        with open(path + ".tmp", "w") as f: json.dump({"plan": self.plan, "done": self.done}, f, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def pending(self):
+        return [(p, pt) for p, pt in self.runs if point_id(pt) not in self.done]
+
+    def transitions(self):
+        """(camera, wave) setting changes over the pending runs, counting the first run."""
+        prev = (None, None); cam = wave = 0
+        for p, pt in self.pending():
+            key = cost_key(p, pt)[:2]
+            cam += key[0] != prev[0]; wave += key[:2] != prev
+            prev = key
+        return cam, wave
+
+    def run(self, hw, camera=None, status=print, stop_event=None):
+        """Runs every pending point; returns the number of runs completed. Runs
+        that lost delays in processing are not marked done, so a resume repeats them."""
+        import scan
+        todo = self.pending()
+        if not os.path.exists(self.folder): os.makedirs(self.folder)
+        print(f"Experiment {self.folder}: {len(todo)} of {len(self.runs)} runs to go, {self.transitions()[0]} camera settings")
+        context = None; completed = failed = 0
+        for n, (p, pt) in enumerate(todo, 1):
+            pid = point_id(pt)
+            scan_dir = os.path.join(self.folder, f"{pid}_{point_label(pt)}")
+            if os.path.exists(scan_dir): shutil.rmtree(scan_dir)  # Leftover of an interrupted run
+            # The context frame depends on the camera settings only: take it once per group
+            cam_key = cost_key(p, pt)[0]
+            reuse = p.get("v_ctx") and context is not None and context[0] == cam_key and os.path.exists(context[1])
+            params = {**p, "v_ctx": False} if reuse else dict(p)
+            tag = lambda s, n=n: status(f"[{n}/{len(todo)}] {s}")
+            engine = scan.ScanEngine(hw, params, status=tag, stop_event=stop_event, camera=camera, scan_dir=scan_dir)
+            engine.run(False)
+            if stop_event is not None and stop_event.is_set():
+                print(f"Experiment stopped, {len(todo) - completed} runs left"); break
+            ref = os.path.join(scan_dir, "ref_context.png")
+            if reuse: shutil.copy(context[1], ref)
+            elif p.get("v_ctx"): context = (cam_key, ref)
+            if engine.failed:
+                print(f"Run {pid}: {engine.failed} delays failed ({engine.error}), left pending"); failed += 1; continue
+            self.done[pid] = {"point": pt, "scan_dir": scan_dir}
+            self.save_progress(); completed += 1
+        if failed: print(f"Experiment: {failed} runs failed and will be repeated on resume")
+        return completed
+
+def load_plan(path):
+    with open(path) as f: return json.load(f)
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python experiment.py")
+    ap.add_argument("plan", help="experiment plan JSON")
+    ap.add_argument("--settings", help="settings file (File > Save) under the plan's base")
+    ap.add_argument("--out", help="experiment folder (default experiments/<name>)")
+    ap.add_argument("--dry-run", action="store_true", help="print the run order and exit")
+    args = ap.parse_args(argv)
+
+    settings = load_plan(args.settings) if args.settings else {}
+    if not args.dry_run:
+        import scan
+        # Headless: scan defaults for keys neither the settings nor the plan set
+        settings = {**scan.DEFAULT_PARAMS, **settings}
+    exp = Experiment(load_plan(args.plan), settings, args.out)
+    if args.dry_run:
+        for p, pt in exp.runs:
+            print(f"{'done' if point_id(pt) in exp.done else '    '} {point_id(pt)} {pt}")
+        print(f"{len(exp.pending())} pending, camera/wave changes: {exp.transitions()}")
+        return
+
+    import camera
+    import hardware
+    hw = hardware.HardwareManager(); cam = camera.CameraManager()
+    try: exp.run(hw, cam)
+    finally: cam.close(); hw.cleanup()
+
+if __name__ == "__main__":
+    main()
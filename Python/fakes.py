@@ -0,0 +1,345 @@
+# fakes.py
+# Simulated picamera2 and pigpio backends for benchmarking off the Pi.
+#   import fakes; fakes.install()   # before importing hardware / scan / main
+# The fake pigpio daemon keeps the waves it is given and knows from their
+# pulses when the camera trigger pin falls. The fake camera delivers one frame
+# per trigger, at that time, showing signal frames (sine pass) or background
+# frames (no sine pass).
+import sys
+import threading
+import time
+import types
+import cv2
+import numpy as np
+
+import config
+
+FREE_RUN_FPS = 30      # camera rate while no wave is transmitting
+READOUT_S = 0.002      # trigger to frame delivery, on top of the exposure
+
+class error(Exception):
+    pass
+
+class pulse:
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+def triggers(pulses):
+    """(duration_us, [(trigger_us, is_signal, delay_us), ...]) for one pass of a wave.
+
+    A pass is signal if the sine pin toggled in it before the trigger; its
+    delay is measured from the first sine edge. A pass ends at the first long
+    (padding) pulse after the camera pin has risen again. Carriers that fell
+    back to PWM are not seen, so their passes read as background.
+    """
+    cam, sine = 1 << config.PIN_CAM, 1 << config.PIN_SINE
+    level, t, out = cam, 0, []
+    sine_t = None; triggered = False
+    for p in pulses:
+        new = (level | p.gpio_on) & ~p.gpio_off
+        if new & sine and not level & sine and sine_t is None: sine_t = t
+        if level & cam and not new & cam:
+            out.append((t, sine_t is not None, t - sine_t if sine_t is not None else 0))
+            triggered = True
+        level = new
+        if triggered and level & cam and p.delay >= 2000: sine_t = None; triggered = False
+        t += p.delay
+    # Background passes carry the delay of their signal pass
+    for i, (tt, sig, d) in enumerate(out):
+        if not sig and i > 0: out[i] = (tt, sig, out[i-1][2])
+    return t, out
+
+class FakePi:
+    """Stand-in for pigpio.pi() with the daemon's wave resource limits."""
+    def __init__(self, host=None, port=None):
+        self.connected = True
+        self.lock = threading.Lock()
+        self.pending = []
+        self.waves = {}          # wid -> (duration_us, triggers)
+        self.next_wid = 0
+        self.schedule = None     # (t0, [(wid, repeats or None=forever, (duration_us, triggers)), ...])
+        self.log = []            # (host time, call, argument)
+        self.created = 0
+        fakes_state["pi"] = self
+
+    # --- GPIO / PWM ---
+    def set_mode(self, gpio, mode): pass
+    def write(self, gpio, level): pass
+    def hardware_PWM(self, gpio, freq, duty): self.log.append((time.perf_counter(), "hardware_PWM", freq))
+    def set_PWM_frequency(self, gpio, freq): return freq
+    def set_PWM_dutycycle(self, gpio, duty): pass
+    def stop(self): self.connected = False
+
+    # --- Waves ---
+    def wave_clear(self):
+        with self.lock: self.waves.clear(); self.pending = []; self.schedule = None
+
+    def wave_add_new(self): self.pending = []
+
+    def wave_add_generic(self, pulses):
+        self.pending.extend(pulses)
+        return len(self.pending)
+
+    def wave_get_cbs(self): return 3 * len(self.pending) + 1
+    def wave_get_max_cbs(self): return config.WAVE_MAX_CBS
+
+    def wave_create(self):
+        with self.lock:
+            if len(self.pending) > config.WAVE_MAX_PULSES or len(self.waves) >= config.WAVE_MAX_IDS:
+                raise error("no more waves / pulses")
+            while self.next_wid in self.waves: self.next_wid = (self.next_wid + 1) % config.WAVE_MAX_IDS
+            wid = self.next_wid
+            self.waves[wid] = triggers(self.pending)
+            self.pending = []; self.created += 1
+            return wid
+
+    def wave_delete(self, wid):
+        with self.lock: self.waves.pop(wid, None)
+
+    def wave_send_using_mode(self, wid, mode):
+        with self.lock:
+            if wid not in self.waves: raise error("wave not found")
+            now = time.perf_counter(); t0 = now
+            if mode in (WAVE_MODE_REPEAT_SYNC, WAVE_MODE_ONE_SHOT_SYNC) and self.schedule:
+                # Starts at the end of the current wave's period
+                cur = self._current(now)
+                if cur: t0 = cur[1] + cur[2]
+            forever = mode in (WAVE_MODE_REPEAT, WAVE_MODE_REPEAT_SYNC)
+            self.schedule = (t0, [(wid, None if forever else 1, self.waves[wid])])
+            self.log.append((now, "send", wid))
+        return 0
+
+    def wave_chain(self, data):
+        with self.lock:
+            seq = _parse_chain(list(data))
+            if any(w not in self.waves for w, _ in seq): raise error("wave not found")
+            # Timing is kept with the schedule: a frame read late still finds its
+            # trigger after the sender deleted the waves
+            self.schedule = (time.perf_counter(), [(w, n, self.waves[w]) for w, n in seq])
+            self.log.append((self.schedule[0], "chain", len(seq)))
+        return 0
+
+    def wave_tx_stop(self):
+        with self.lock: self.schedule = None
+
+    def _current(self, now):
+        """(wid, start time of its current repeat, duration) at host time now, or None when idle."""
+        if not self.schedule: return None
+        t, seq = self.schedule
+        for wid, reps, wave in seq:
+            d = wave[0] / 1e6
+            if d <= 0: continue
+            if reps is None or now < t + reps * d: return wid, t + max(0, (now - t) // d) * d, d
+            t += reps * d
+        return None
+
+    def wave_tx_at(self):
+        with self.lock:
+            cur = self._current(time.perf_counter())
+            return cur[0] if cur else 9999
+
+    def wave_tx_busy(self):
+        with self.lock: return 1 if self._current(time.perf_counter()) else 0
+
+    def next_trigger(self, after):
+        """(host time, is_signal, delay_us) of the first camera trigger after `after`, or None."""
+        with self.lock:
+            if not self.schedule: return None
+            t, seq = self.schedule
+            for wid, reps, (d, trig) in seq:
+                d /= 1e6
+                if d <= 0 or not trig: continue
+                n = reps if reps is not None else 1 << 62
+                k = max(0, int((after - t) // d))
+                for rep in (k, k + 1):
+                    if rep >= n: break
+                    for off, sig, delay in trig:
+                        tt = t + rep * d + off / 1e6
+                        if tt > after: return tt, sig, delay
+                if reps is None: return None
+                t += reps * d
+            return None
+
+def _parse_chain(data):
+    """Flattens a wave_chain byte list into [(wid, repeats)] (loops expanded)."""
+    out, stack, i = [], [], 0
+    while i < len(data):
+        b = data[i]
+        if b == 255:
+            cmd = data[i+1]
+            if cmd == 0: stack.append(len(out)); i += 2
+            elif cmd == 1:
+                reps = data[i+2] + 256 * data[i+3]; start = stack.pop()
+                body = out[start:]; out[start:] = body * reps; i += 4
+            elif cmd == 2: i += 4
+            else: i += 2
+        else:
+            out.append((b, 1)); i += 1
+    # Merge runs of one wave so long loops stay cheap to walk
+    merged = []
+    for wid, n in out:
+        if merged and merged[-1][0] == wid: merged[-1] = (wid, merged[-1][1] + n)
+        else: merged.append((wid, n))
+    return merged
+
+class Scene:
+    """Synthetic schlieren frames: fixed background with vignetting and fixed
+    pattern noise; signal frames add an expanding acoustic ring whose radius
+    follows the delay."""
+    def __init__(self, seed=0, px_per_us=0.02, amplitude=12.0):
+        self.rng = np.random.default_rng(seed)
+        self.px_per_us = px_per_us
+        self.amplitude = amplitude
+        self.cache = {}
+
+    def _base(self, h, w):
+        key = ("base", h, w)
+        if key not in self.cache:
+            y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+            r2 = ((x - w / 2) / w) ** 2 + ((y - h / 2) / h) ** 2
+            base = 150 - 120 * r2 + self.rng.normal(0, 2, (h, w)).astype(np.float32)
+            noise = [self.rng.normal(0, 3, (h, w)).astype(np.float32) for _ in range(4)]
+            self.cache[key] = (base, noise, np.sqrt((x - w / 2) ** 2 + (y - h / 2) ** 2))
+        return self.cache[key]
+
+    def frame(self, h, w, is_signal, delay_us, n):
+        base, noise, r = self._base(h, w)
+        img = base + noise[n % len(noise)]
+        if is_signal:
+            radius = 20 + (delay_us * self.px_per_us) % (max(h, w) / 2)
+            # Derivative of a Gaussian shell: light and dark fringe pair
+            d = (r - radius) / 6.0
+            img = img + self.amplitude * (-d) * np.exp(-d * d)
+        return np.clip(img, 0, 255).astype(np.uint8)
+
+class Picamera2:
+    """Fake camera: frames arrive at the fake pigpio's camera triggers. New
+    controls reach the frame metadata CONTROL_LATENCY frames later, as on the
+    real sensor. Only the newest BUFFERS frames wait to be read, and drop_rate
+    loses frames at random, to exercise the frame pairing."""
+    scene = Scene()
+    CONTROL_LATENCY = 2
+    BUFFERS = 4
+    drop_rate = 0.0           # fraction of triggers that deliver no frame
+    rng = np.random.default_rng(1)
+
+    # (min, max, default); frames are drawn at the output size whatever the crop
+    camera_controls = {"ScalerCrop": ((0, 0, 64, 64), (0, 0, 4056, 3040), (0, 0, 4056, 3040)),
+                       "ExposureTime": (1, 66666, 1000), "AnalogueGain": (1.0, 16.0, 1.0)}
+
+    def __init__(self, camera_num=0):
+        self.size = (640, 480)
+        self.format = "RGB888"
+        self.controls = {}        # as applied to the sensor
+        self.pending = []         # (frame index, controls) not yet applied
+        self.started = False
+        self.last_t = 0.0
+        self.n = 0
+
+    def create_video_configuration(self, main=None, **kwargs):
+        return {"main": dict(main or {}), **kwargs}
+    create_preview_configuration = create_still_configuration = create_video_configuration
+
+    def configure(self, cfg):
+        main = cfg.get("main", {})
+        self.size = tuple(main.get("size", self.size))
+        self.format = main.get("format", self.format)
+
+    def set_controls(self, controls): self.pending.append((self.n + self.CONTROL_LATENCY, dict(controls)))
+
+    def start(self):
+        self.started = True; self.last_t = time.perf_counter()
+
+    def stop(self): self.started = False
+    def close(self): self.started = False
+
+    def _next(self):
+        """Waits for the next trigger; returns (is_signal, delay_us, metadata)."""
+        while self.pending and self.pending[0][0] <= self.n: self.controls.update(self.pending.pop(0)[1])
+        exp = self.controls.get("ExposureTime", 1000) / 1e6
+        pi = fakes_state.get("pi")
+        trig = pi.next_trigger(self.last_t) if pi else None
+        # A frame not read before BUFFERS newer ones arrived has been overwritten
+        while trig is not None and self._late(pi, trig[0]): trig = pi.next_trigger(trig[0])
+        if trig is None:
+            trig = (max(time.perf_counter(), self.last_t + 1.0 / FREE_RUN_FPS), False, 0)
+        t, sig, delay = trig
+        self.last_t = t
+        if self.drop_rate and self.rng.random() < self.drop_rate: return self._next()
+        wait = t + exp + READOUT_S - time.perf_counter()
+        if wait > 0: time.sleep(wait)
+        # SensorTimestamp is CLOCK_BOOTTIME, trigger times are perf_counter
+        boot = time.clock_gettime_ns(time.CLOCK_BOOTTIME) - int(time.perf_counter() * 1e9)
+        md = {"SensorTimestamp": int(t * 1e9) + boot, "ExposureTime": self.controls.get("ExposureTime", 1000),
+              "AnalogueGain": self.controls.get("AnalogueGain", 1.0), "FrameIndex": self.n}
+        self.n += 1
+        return sig, delay, md
+
+    def _late(self, pi, t):
+        for _ in range(self.BUFFERS):
+            nxt = pi.next_trigger(t)
+            if nxt is None or nxt[0] > time.perf_counter(): return False
+            t = nxt[0]
+        return True
+
+    def _image(self, sig, delay, n):
+        w, h = self.size
+        gray = self.scene.frame(h, w, sig, delay, n)
+        if self.format in ("RGB888", "BGR888"): return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+        if self.format in ("XRGB8888", "XBGR8888"): return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGRA)
+        if self.format in ("YUV420", "YVU420"):
+            # Y plane, then quarter-size U and V planes, as rows of a padded stride
+            stride = (w + 63) // 64 * 64
+            buf = np.full((h * 3 // 2, stride), 128, np.uint8)
+            buf[:h, :w] = gray
+            return buf
+        return gray
+
+    def capture_array(self, name="main"):
+        sig, delay, md = self._next()
+        return self._image(sig, delay, md["FrameIndex"])
+
+    def capture_metadata(self):
+        return self._next()[2]
+
+    def capture_request(self):
+        sig, delay, md = self._next()
+        return FakeRequest(self._image(sig, delay, md["FrameIndex"]), md)
+
+class FakeRequest:
+    def __init__(self, array, metadata=None):
+        self.array = array
+        self.metadata = metadata or {}
+    def make_array(self, name="main"): return self.array.copy()
+    def get_metadata(self): return dict(self.metadata)
+    def release(self): self.array = None
+
+class MappedArray:
+    def __init__(self, request, stream, reshape=True, write=True):
+        self.request = request
+    def __enter__(self):
+        self.array = self.request.array
+        return self
+    def __exit__(self, *exc):
+        self.array = None
+
+fakes_state = {}
+
+def _pigpio_module():
+    m = types.ModuleType("pigpio")
+    m.pi = FakePi; m.pulse = pulse; m.error = error
+    m.OUTPUT, m.INPUT = 1, 0
+    m.WAVE_MODE_ONE_SHOT, m.WAVE_MODE_REPEAT = WAVE_MODE_ONE_SHOT, WAVE_MODE_REPEAT
+    m.WAVE_MODE_ONE_SHOT_SYNC, m.WAVE_MODE_REPEAT_SYNC = WAVE_MODE_ONE_SHOT_SYNC, WAVE_MODE_REPEAT_SYNC
+    return m
+
+WAVE_MODE_ONE_SHOT, WAVE_MODE_REPEAT, WAVE_MODE_ONE_SHOT_SYNC, WAVE_MODE_REPEAT_SYNC = 0, 1, 2, 3
+
+def install():
+    """Registers the fakes as the picamera2 and pigpio modules. Call before
+    hardware, scan or main are imported."""
+    cam = types.ModuleType("picamera2"); cam.Picamera2 = Picamera2; cam.MappedArray = MappedArray
+    sys.modules["picamera2"] = cam
+    sys.modules["pigpio"] = _pigpio_module()
@@ -1,7 +1,13 @@
 # hardware.py
 import pigpio
+import numpy as np
+import threading
+import queue
+import time
+from collections import OrderedDict
 from itertools import groupby
 import config
+import perf
 
 class HardwareManager:
     def __init__(self):
@@ -18,48 +24,294 @@ class HardwareManager:
         self.pi.write(config.PIN_CAM, 1) 
         
         self.current_wid = -1
+        self.current_key = None
+        # Created waves, least recently used first: key -> (wid, control blocks)
+        self.waves = OrderedDict()
+        self.wave_lock = threading.RLock()
+        self.prefetch_queue = queue.Queue()
+        self.prefetch_thread = None
+        # Waves whose carrier didn't fit the pulse budget and runs as PWM instead
+        self.pwm_carrier = set()
+        self.carrier_freq = 0
+        try: self.max_cbs = self.pi.wave_get_max_cbs()
+        except: self.max_cbs = config.WAVE_MAX_CBS
         self.pi.wave_tx_stop()
         self.pi.wave_clear()
 
     def stop(self):
         try:
-            self.pi.wave_tx_stop()
-            self.pi.wave_clear()
-            self.current_wid = -1
+            with self.wave_lock:
+                self.pi.wave_tx_stop()
+                self.pi.wave_clear()
+                self.waves.clear()
+                self.current_wid = -1
+                self.current_key = None
+                self.pwm_carrier.clear()
+                self._set_carrier(0)
         except: pass
 
+    def _set_carrier(self, freq):
+        """Free-running carrier on PIN_SINE, used only when a burst exceeds the wave budget.
+
+        It is not phase-locked to the trigger and also runs during background
+        frames, so it is only a fallback for bursts longer than the frame.
+        """
+        if freq == self.carrier_freq: return
+        if config.PIN_SINE in (12, 13, 18, 19):
+            self.pi.hardware_PWM(config.PIN_SINE, int(freq), 500000 if freq > 0 else 0)
+        elif freq > 0:
+            actual = self.pi.set_PWM_frequency(config.PIN_SINE, int(freq))
+            if actual != freq: print(f"PWM carrier: {freq} Hz not available on GPIO {config.PIN_SINE}, using {actual} Hz")
+            self.pi.set_PWM_dutycycle(config.PIN_SINE, 128)
+        else:
+            self.pi.set_PWM_dutycycle(config.PIN_SINE, 0)
+        self.carrier_freq = freq
+
     def cleanup(self):
         self.stop()
         self.pi.stop()
 
-    def update_wave(self, delay_us, cam_exp, led_on, freq, cycles, fps, sine_en=True, led_en=True, interleaved=False):
-        try:
-            # Calculate Padding based on FPS
-            total_period_us = int(1000000.0 / max(1, fps))
-            padding_us = int(total_period_us / 2) if interleaved else total_period_us
-            padding_us = max(2000, padding_us)
+    @staticmethod
+    def wave_key(delay_us, cam_exp, led_on, freq, cycles, fps, sine_en=True, led_en=True, interleaved=False):
+        return (int(delay_us), int(cam_exp), int(led_on), int(freq), int(cycles), int(fps), bool(sine_en), bool(led_en), bool(interleaved))
 
-            pulses = self._build_pulses(delay_us, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us)
-            
-            self.pi.wave_add_generic(pulses)
-            new_wid = self.pi.wave_create()
-            
-            if new_wid >= 0:
-                self.pi.wave_send_repeat(new_wid)
-                if self.current_wid >= 0:
-                    try: self.pi.wave_delete(self.current_wid)
-                    except: pass
-                self.current_wid = new_wid
-            else:
-                self.pi.wave_clear()
+    @staticmethod
+    def pass_end(key, sine, carrier=True):
+        """Time of the last edge in one pass of the wave, in us."""
+        delay_us, cam_exp, led_on, freq, cycles, fps, sine_en, led_en, interleaved = key
+        end = int(delay_us + cam_exp)
+        if led_en: end = max(end, int(delay_us + led_on))
+        if sine and freq > 0 and carrier and int(cycles) > 0:
+            period = 1000000 / freq
+            end = max(end, int(int((int(cycles) - 1) * period) + period/2))
+        return end
+
+    @staticmethod
+    def wave_timing(key):
+        """Pass lengths in us: (signal, background) for interleaved waves, (period,) otherwise.
+
+        Interleaved passes are padded to fixed lengths around half the trigger
+        period, the background pass config.PHASE_MARK_US longer and the signal
+        pass as much shorter, so frame timestamps tell the phases apart.
+        """
+        delay_us, cam_exp, led_on, freq, cycles, fps, sine_en, led_en, interleaved = key
+        total_period_us = int(1000000.0 / max(1, fps))
+        if not interleaved:
+            return (HardwareManager.pass_end(key, sine_en) + max(2000, total_period_us),)
+        half, mark = total_period_us // 2, config.PHASE_MARK_US
+        sig = max(half - mark, HardwareManager.pass_end(key, sine_en) + 2000)
+        bg = max(half + mark, HardwareManager.pass_end(key, False) + 2000, sig + 2 * mark)
+        return sig, bg
+
+    @staticmethod
+    def wave_pulses(key, carrier=True, builder=None):
+        delay_us, cam_exp, led_on, freq, cycles, fps, sine_en, led_en, interleaved = key
+        # Padding after each pass, from the pass lengths the trigger FPS asks for
+        total_period_us = int(1000000.0 / max(1, fps))
+        if interleaved:
+            sig, bg = HardwareManager.wave_timing(key)
+            padding_us = (sig - HardwareManager.pass_end(key, sine_en, carrier), bg - HardwareManager.pass_end(key, False, carrier))
+        else:
+            padding_us = max(2000, total_period_us)
+
+        if builder is None: return HardwareManager._build_pulses(delay_us, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us, carrier)
+        return builder(delay_us, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us)
+
+    def wave_budget(self, *wave_args):
+        """Pulse and DMA control block usage of a wave, before it is created."""
+        return pulse_budget(self.wave_pulses(self.wave_key(*wave_args)), self.max_cbs)
+
+    def _create_wave(self, key):
+        pulses = self.wave_pulses(key)
+        budget = pulse_budget(pulses, self.max_cbs)
+        if budget["pulses_frac"] > 1.0 or budget["cbs_frac"] > 1.0:
+            # Too many carrier edges for one wave: leave PIN_SINE to PWM
+            print(f"Wave over budget ({budget['pulses']} pulses), carrier falls back to PWM")
+            pulses = self.wave_pulses(key, carrier=False)
+            self.pwm_carrier.add(key)
+        elif config.PULSE_VERIFY:
+            check = compare_builders(key)
+            if not check["equal"]: print(f"Pulse compiler mismatch for {key}: {check}")
+
+        with self.wave_lock:
+            while True:
+                # Make room: pigpio limits both wave IDs and DMA control blocks
+                while len(self.waves) >= config.WAVE_MAX_IDS and self._evict(): pass
+                try:
+                    self.pi.wave_add_new()
+                    self.pi.wave_add_generic(pulses)
+                    cbs = self.pi.wave_get_cbs()
+                    while self.waves and sum(c for _, c in self.waves.values()) + cbs > self.max_cbs and self._evict(): pass
+                    wid = self.pi.wave_create()
+                except pigpio.error:
+                    wid = -1
+                if wid >= 0:
+                    self.waves[key] = (wid, cbs)
+                    return wid
+                # Out of resources or fragmented: drop the oldest wave and retry
+                if not self._evict(): return -1
+
+    def _evict(self):
+        for key, (wid, _) in self.waves.items():
+            if key == self.current_key: continue
+            del self.waves[key]
+            try: self.pi.wave_delete(wid)
+            except: pass
+            return True
+        return False
+
+    def _get_wave(self, key):
+        with self.wave_lock:
+            if key in self.waves:
+                self.waves.move_to_end(key)
+                return self.waves[key][0]
+            return self._create_wave(key)
+
+    @perf.probe("update_wave")
+    def update_wave(self, delay_us, cam_exp, led_on, freq, cycles, fps, sine_en=True, led_en=True, interleaved=False, sync=False):
+        try:
+            key = self.wave_key(delay_us, cam_exp, led_on, freq, cycles, fps, sine_en, led_en, interleaved)
+            with self.wave_lock:
+                new_wid = self._get_wave(key)
+                if new_wid < 0: return
+                if new_wid != self.current_wid:
+                    # REPEAT_SYNC switches at the end of the running wave's period
+                    mode = pigpio.WAVE_MODE_REPEAT_SYNC if sync and self.current_wid >= 0 else pigpio.WAVE_MODE_REPEAT
+                    self.pi.wave_send_using_mode(new_wid, mode)
+                    self.current_wid = new_wid
+                    self.current_key = key
+                    self._set_carrier(key[3] if key in self.pwm_carrier and key[6] else 0)
         except Exception as e:
             print(f"Hardware Error: {e}")
 
-    def _build_pulses(self, delay, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us):
+    def wait_for_wave(self, timeout=1.0):
+        """Block until the wave selected by the last update_wave is actually transmitting."""
+        end = time.monotonic() + timeout
+        while time.monotonic() < end:
+            try:
+                if self.pi.wave_tx_at() == self.current_wid: return True
+            except: return False
+            time.sleep(0.001)
+        return False
+
+    def prefetch(self, wave_args):
+        """Create waves for upcoming update_wave(*args) calls in the background."""
+        for args in wave_args: self.prefetch_queue.put(self.wave_key(*args))
+        if self.prefetch_thread is None or not self.prefetch_thread.is_alive():
+            self.prefetch_thread = threading.Thread(target=self._run_prefetch, daemon=True)
+            self.prefetch_thread.start()
+
+    def _run_prefetch(self):
+        while True:
+            try: key = self.prefetch_queue.get(timeout=1.0)
+            except queue.Empty: return
+            try: self._get_wave(key)
+            except Exception as e: print(f"Hardware Error: {e}")
+
+    @staticmethod
+    def _build_pulses(delay, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us, carrier=True):
+        """Minimal pulse list for one wave.
+
+        Edges are compiled with NumPy into a (mask, duration) timeline, so
+        coincident edges merge, zero-length pulses disappear and consecutive
+        pulses with the same mask are joined. The output level at every
+        microsecond matches _build_pulses_reference (see compare_builders).
+        carrier=False leaves PIN_SINE out of the wave entirely.
+
+        NumPy's per-call overhead only pays off on long carriers: below
+        config.PULSE_NUMPY_MIN_CYCLES the same timeline is built by
+        _build_pulses_scalar.
+        """
+        if not (sine_en and freq > 0 and carrier) or int(cycles) < config.PULSE_NUMPY_MIN_CYCLES:
+            return HardwareManager._build_pulses_scalar(delay, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us, carrier)
+        SINE, LED, CAM = 1 << config.PIN_SINE, 1 << config.PIN_LED, 1 << config.PIN_CAM
+        ALL = (SINE if carrier else 0) | LED | CAM
+        passes = [sine_en, False] if interleaved else [sine_en]
+        pads = padding_us if isinstance(padding_us, tuple) else (padding_us,) * len(passes)
+        masks, durations = [], []
+
+        for current_sine_state, pad in zip(passes, pads):
+            # Events in the same order the reference builder appends them, so the stable sort matches
+            t = [np.array([int(delay), int(delay + cam_exp)], np.int64)]
+            bit = [np.array([CAM, CAM], np.int64)]
+            on = [np.array([False, True])]
+            if current_sine_state and freq > 0 and carrier:
+                period = 1000000 / freq
+                t_on = (np.arange(int(cycles)) * period).astype(np.int64)
+                t.append(np.column_stack([t_on, (t_on + period/2).astype(np.int64)]).ravel())
+                bit.append(np.full(2 * int(cycles), SINE, np.int64))
+                on.append(np.tile([True, False], int(cycles)))
+            else:
+                t.append(np.array([0], np.int64)); bit.append(np.array([SINE], np.int64)); on.append(np.array([False]))
+            if led_en:
+                t.append(np.array([int(delay), int(delay + led_on)], np.int64))
+                bit.append(np.array([LED, LED], np.int64)); on.append(np.array([True, False]))
+
+            t, bit, on = np.concatenate(t), np.concatenate(bit), np.concatenate(on)
+            order = np.argsort(t, kind='stable')
+            t, bit, on = t[order], bit[order], on[order]
+
+            # Mask after each event: every pin holds the value of its most recent event
+            idx = np.arange(len(t))
+            mask = np.zeros(len(t), np.int64)
+            for b, init in ((SINE, False), (LED, False), (CAM, True)):
+                last = np.maximum.accumulate(np.where(bit == b, idx, -1))
+                level = np.where(last >= 0, on[np.maximum(last, 0)], init)
+                mask |= np.where(level, b, 0)
+            mask &= ALL
+
+            # One segment per distinct timestamp, holding the mask after its last event
+            ends = np.r_[t[1:] != t[:-1], True]
+            seg_t, seg_mask = t[ends], mask[ends]
+            masks += [CAM & ALL] + list(seg_mask)
+            durations += [seg_t[0]] + list(np.diff(seg_t)) + [pad]
+
+        masks, durations = np.array(masks, np.int64), np.array(durations, np.int64)
+        keep = durations > 0
+        masks, durations = masks[keep], durations[keep]
+        starts = np.flatnonzero(np.r_[True, masks[1:] != masks[:-1]])
+        masks, durations = masks[starts], np.add.reduceat(durations, starts)
+        return [pigpio.pulse(int(m), ALL & ~int(m), int(d)) for m, d in zip(masks, durations)]
+
+    @staticmethod
+    def _build_pulses_scalar(delay, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us, carrier=True):
+        """_build_pulses in plain Python, for short carriers."""
+        SINE, LED, CAM = 1 << config.PIN_SINE, 1 << config.PIN_LED, 1 << config.PIN_CAM
+        ALL = (SINE if carrier else 0) | LED | CAM
+        passes = [sine_en, False] if interleaved else [sine_en]
+        pads = padding_us if isinstance(padding_us, tuple) else (padding_us,) * len(passes)
+        segments = []
+
+        for current_sine_state, pad in zip(passes, pads):
+            events = [(int(delay), CAM, False), (int(delay + cam_exp), CAM, True)]
+            if current_sine_state and freq > 0 and carrier:
+                period = 1000000 / freq
+                for i in range(int(cycles)):
+                    t = int(i * period)
+                    events += [(t, SINE, True), (int(t + period/2), SINE, False)]
+            if led_en: events += [(int(delay), LED, True), (int(delay + led_on), LED, False)]
+            events.sort(key=lambda e: e[0])
+
+            mask, last_t = CAM, 0
+            for t, bit, on in events:
+                if t > last_t: segments.append((mask & ALL, t - last_t)); last_t = t
+                mask = mask | bit if on else mask & ~bit
+            segments.append((mask & ALL, pad))
+
+        pulses = []
+        for m, d in segments:
+            if d <= 0: continue
+            if pulses and pulses[-1][0] == m: pulses[-1][1] += d
+            else: pulses.append([m, d])
+        return [pigpio.pulse(m, ALL & ~m, d) for m, d in pulses]
+
+    @staticmethod
+    def _build_pulses_reference(delay, cam_exp, led_on, freq, cycles, sine_en, led_en, interleaved, padding_us):
         all_pulses = []
         passes = [sine_en, False] if interleaved else [sine_en]
+        pads = padding_us if isinstance(padding_us, tuple) else (padding_us,) * len(passes)
         
-        for current_sine_state in passes:
+        for current_sine_state, pad in zip(passes, pads):
             events = []
             events.append((int(delay), 'off', config.PIN_CAM))
             events.append((int(delay + cam_exp), 'on', config.PIN_CAM))
@@ -95,6 +347,153 @@ class HardwareManager:
                 all_pulses.append(pigpio.pulse(curr_mask, ALL & ~curr_mask, 0))
                 last_t = t
             
-            all_pulses.append(pigpio.pulse(curr_mask, ALL & ~curr_mask, padding_us))
+            all_pulses.append(pigpio.pulse(curr_mask, ALL & ~curr_mask, pad))
 
         return all_pulses
+
+
+def simulate_pulses(pulses):
+    """Output mask at every microsecond of a pulse list (zero-length pulses take no time)."""
+    masks = np.array([p.gpio_on for p in pulses], np.int64)
+    return np.repeat(masks, [p.delay for p in pulses])
+
+def compare_builders(key):
+    """Check the compiled pulse list against the reference builder on a sampled timeline."""
+    new = HardwareManager.wave_pulses(key)
+    ref = HardwareManager.wave_pulses(key, builder=HardwareManager._build_pulses_reference)
+    a, b = simulate_pulses(new), simulate_pulses(ref)
+    return {"equal": a.shape == b.shape and bool(np.array_equal(a, b)), "pulses": len(new), "reference_pulses": len(ref)}
+
+def pulse_budget(pulses, max_cbs=config.WAVE_MAX_CBS):
+    cbs = estimate_cbs(pulses)
+    return {"pulses": len(pulses), "cbs": cbs,
+            "pulses_frac": len(pulses) / config.WAVE_MAX_PULSES, "cbs_frac": cbs / max_cbs}
+
+def estimate_cbs(pulses):
+    # Upper bound used when the daemon can't be asked: gpio set, gpio clear and delay per pulse
+    return 3 * len(pulses) + 1
+
+class Sequencer:
+    """Runs a whole delay sweep as chained pigpio waves, with no host round-trips per delay.
+
+    Each delay is one interleaved (signal, background) wave repeated `stack`
+    times by a chain loop. Sweeps that don't fit one chain (byte, loop counter
+    or wave resource limits) are split into segments, and the next segment's
+    waves are created while the current one transmits. With hw=None only
+    compile() and dry_run() are usable.
+    """
+    def __init__(self, hw, delays, stack, cam_exp, led_on, freq, cycles, fps, sine_en=True, led_en=True):
+        self.hw = hw
+        self.delays = list(delays)
+        self.stack = max(1, min(int(stack), 65535))
+        self.keys = [HardwareManager.wave_key(d, cam_exp, led_on, freq, cycles, fps, sine_en, led_en, True) for d in self.delays]
+        self.stop_event = threading.Event()
+        self.done = threading.Event()
+        self.thread = None
+        self.segments = None
+        self.starts = []         # (CLOCK_BOOTTIME ns, first wave period) of each chain sent
+
+    def schedule(self):
+        """(delay, 'sig' | 'bg', repeat) for every camera frame, in trigger order."""
+        return [(d, phase, r) for d in self.delays for r in range(self.stack) for phase in ('sig', 'bg')]
+
+    def _entry_bytes(self):
+        return 7 if self.stack > 1 else 1
+
+    def compile(self):
+        max_cbs = self.hw.max_cbs if self.hw else config.WAVE_MAX_CBS
+        self.pulses = {k: HardwareManager.wave_pulses(k) for k in self.keys}
+        # Half the resources each, so the next segment can be built while one runs
+        limit_waves, limit_cbs = config.WAVE_MAX_IDS // 2, max_cbs // 2
+        self.segments = []; seg = []; cbs = 0
+        for k in self.keys:
+            c = estimate_cbs(self.pulses[k])
+            full = (len(seg) + 1) * self._entry_bytes() > config.WAVE_CHAIN_MAX_BYTES or \
+                   (self.stack > 1 and len(seg) + 1 > config.WAVE_CHAIN_MAX_LOOPS) or \
+                   len(seg) + 1 > limit_waves or cbs + c > limit_cbs
+            if seg and full: self.segments.append(seg); seg = []; cbs = 0
+            seg.append(k); cbs += c
+        if seg: self.segments.append(seg)
+        return self.segments
+
+    def dry_run(self):
+        if self.segments is None: self.compile()
+        wave_us = {k: sum(p.delay for p in self.pulses[k]) for k in self.keys}
+        return {
+            "delays": len(self.delays),
+            "frames": 2 * self.stack * len(self.delays),
+            "segments": len(self.segments),
+            "waves": len(self.keys),
+            "pulses_max": max((len(p) for p in self.pulses.values()), default=0),
+            "chain_bytes_max": max((len(s) * self._entry_bytes() for s in self.segments), default=0),
+            "cbs_max": max((sum(estimate_cbs(self.pulses[k]) for k in s) for s in self.segments), default=0),
+            "duration_s": sum(wave_us[k] for k in self.keys) * self.stack / 1e6,
+        }
+
+    def _chain(self, wids):
+        chain = []
+        for wid in wids:
+            if self.stack > 1: chain += [255, 0, wid, 255, 1, self.stack & 255, self.stack >> 8]
+            else: chain.append(wid)
+        return chain
+
+    def _create(self, seg):
+        pi = self.hw.pi; wids = []
+        with self.hw.wave_lock:
+            for k in seg:
+                pi.wave_add_new()
+                pi.wave_add_generic(self.pulses[k])
+                wids.append(pi.wave_create())
+        return wids
+
+    def _delete(self, wids):
+        for wid in wids:
+            try: self.hw.pi.wave_delete(wid)
+            except: pass
+
+    def _wait_idle(self):
+        while self.hw.pi.wave_tx_busy():
+            if self.stop_event.is_set(): self.hw.pi.wave_tx_stop(); return False
+            time.sleep(0.005)
+        return True
+
+    def _send(self, wids, period):
+        # Each chain restarts the trigger timing; readers place frames from these starts
+        self.starts.append((time.clock_gettime_ns(time.CLOCK_BOOTTIME), period))
+        try:
+            self.hw.pi.wave_chain(self._chain(wids)); return True
+        except pigpio.error:
+            # Rejected (e.g. too many loop counters for this daemon): run it in halves
+            self.starts.pop()
+            if len(wids) == 1: raise
+            half = len(wids) // 2
+            return self._send(wids[:half], period) and self._wait_idle() and self._send(wids[half:], period + half * self.stack)
+
+    def start(self):
+        if self.segments is None: self.compile()
+        # The sequencer owns the wave resources while it runs
+        self.hw.stop()
+        self.stop_event.clear(); self.done.clear()
+        self.starts = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread: self.thread.join(2.0)
+
+    def _run(self):
+        try:
+            wids = self._create(self.segments[0]); prev = []; period = 0
+            for n in range(len(self.segments)):
+                if not self._send(wids, period): break
+                period += len(self.segments[n]) * self.stack
+                self._delete(prev)
+                nxt = self._create(self.segments[n + 1]) if n + 1 < len(self.segments) else []
+                if not self._wait_idle(): self._delete(nxt); break
+                prev, wids = wids, nxt
+            self._delete(prev); self._delete(wids)
+        except Exception as e:
+            print(f"Sequencer Error: {e}")
+        finally:
+            self.done.set()
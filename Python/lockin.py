@@ -0,0 +1,76 @@
+# lockin.py
+# Per-pixel lock-in demodulation over a delay sweep. Each delay's difference
+# image is folded into in-phase/quadrature sums as it arrives, so state stays
+# at two float32 planes per harmonic however many delays are swept:
+#   I_h += D(t) * cos(2 pi h f t),  Q_h -= D(t) * sin(2 pi h f t)
+# Amplitude is 2 |I + iQ| / N and phase arg(I + iQ), at the drive frequency f
+# (and its harmonics h) with t the trigger delay.
+import os
+import threading
+import cv2
+import numpy as np
+
+import config
+
+class LockIn:
+    """Streaming I/Q accumulator; add() is safe to call from several workers."""
+    def __init__(self, freq, harmonics=config.LOCKIN_HARMONICS):
+        self.freq = float(freq)
+        self.harmonics = tuple(int(h) for h in harmonics)
+        self.shape = None
+        self.n = 0
+        self.lock = threading.Lock()
+
+    def check_sampling(self, delays):
+        """Warns when the delay step aliases a harmonic (needs step < 1 / (2 h f))."""
+        d = np.diff(sorted(delays))
+        if not len(d): return True
+        step_s = float(d.max()) * 1e-6
+        bad = [h for h in self.harmonics if step_s * h * self.freq >= 0.5]
+        if bad: print(f"Lock-in: {d.max()}us steps alias harmonics {bad} of {self.freq:.0f} Hz")
+        return not bad
+
+    def add(self, delay_us, diff):
+        """Folds in one delay's difference image (2D float, any dtype)."""
+        w = 2 * np.pi * self.freq * delay_us * 1e-6
+        with self.lock:
+            if diff.shape != self.shape:
+                if self.n: print(f"Lock-in: frame shape changed to {diff.shape}, restarting"); self.n = 0
+                self.shape = diff.shape
+                self.i = np.zeros((len(self.harmonics),) + diff.shape, np.float32)
+                self.q = np.zeros_like(self.i)
+            src = np.asarray(diff, np.float32)
+            for k, h in enumerate(self.harmonics):
+                cv2.scaleAdd(src, float(np.cos(h * w)), self.i[k], dst=self.i[k])
+                cv2.scaleAdd(src, float(-np.sin(h * w)), self.q[k], dst=self.q[k])
+            self.n += 1
+
+    def result(self, k=0):
+        """(amplitude, phase) maps of harmonic index k; amplitude in input units."""
+        amp = 2.0 * np.sqrt(self.i[k] ** 2 + self.q[k] ** 2) / max(1, self.n)
+        return amp, np.arctan2(self.q[k], self.i[k])
+
+    def save(self, folder, prefix="lockin"):
+        """Writes <prefix>_h<h>_amp/_phase as .npy and colormapped .png; returns the paths."""
+        if not self.n: return []
+        paths = []
+        for k, h in enumerate(self.harmonics):
+            amp, phase = self.result(k)
+            base = os.path.join(folder, f"{prefix}_h{h}")
+            np.save(base + "_amp.npy", amp); np.save(base + "_phase.npy", phase)
+            cv2.imwrite(base + "_amp.png", amplitude_png(amp))
+            cv2.imwrite(base + "_phase.png", phase_png(phase, amp))
+            paths += [base + ext for ext in ("_amp.npy", "_phase.npy", "_amp.png", "_phase.png")]
+        return paths
+
+def amplitude_png(amp):
+    # Scaled to the 99.5th percentile so a few hot pixels don't flatten the map
+    top = max(float(np.percentile(amp, 99.5)), 1e-6)
+    return cv2.applyColorMap(np.clip(amp * (255.0 / top), 0, 255).astype(np.uint8), cv2.COLORMAP_INFERNO)
+
+def phase_png(phase, amp=None):
+    """Cyclic colormap of the phase, dimmed where the amplitude is low."""
+    img = cv2.applyColorMap(((phase + np.pi) * (255.0 / (2 * np.pi))).astype(np.uint8), cv2.COLORMAP_TWILIGHT_SHIFTED)
+    if amp is None: return img
+    top = max(float(np.percentile(amp, 99.5)), 1e-6)
+    return (img * np.clip(amp / top, 0, 1)[..., None]).astype(np.uint8)
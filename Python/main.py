@@ -1,20 +1,23 @@
+import time
+START = time.perf_counter() # Time to first preview frame is measured from here
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 from PIL import Image, ImageTk
 import threading
-import time
 import numpy as np
 import cv2
 import json
-import os
-from datetime import datetime
-from picamera2 import Picamera2
 
 # No Matplotlib imports needed for the Clean 2D version
 
+import camera
 import config
+import experiment
 import hardware
+import perf
+import preview
 import processor
+import scan
 
 class CameraApp:
     def __init__(self, root):
@@ -22,13 +25,24 @@ class CameraApp:
         self.root.title("Schlieren Controller v9.0 (2D Final)")
         self.root.geometry("1300x850")
         
-        self.hw = hardware.HardwareManager()
+        # pigpio and the camera come up in init_devices, after the window is shown
+        self.hw = None
+        self.camera = None
+        self.ready = threading.Event()
+        self.first_frame_s = None
         
         # State
         self.stop_event = threading.Event()
         self.lock = threading.Lock()
-        self.latest_frame = None
         self.preview_thread = None
+        self.proc_thread = None
+        self.closing = False
+        # Capture -> processing hands over the newest pair; processing -> Tk through a triple buffer
+        self.raw_slot = preview.LatestSlot()
+        self.display = preview.TripleBuffer()
+        self.display_gen = 0
+        self.info_t = 0.0
+        self.panel_size = (640, 480)
         self.scan_running = False
         
         self.req_bg = False
@@ -37,6 +51,12 @@ class CameraApp:
         self.line_p1 = None
         self.line_p2 = None
         self.show_profile = False
+        # Region of interest as fractions of the frame, dragged out on the preview
+        self.roi = None
+        self.noise_roi = None # Adaptive stacking noise region, same units
+        self.drag_start = None
+        self.drag_roi = None
+        self.display_size = (1, 1)
         
         # Variables
         self.v_freq = tk.IntVar(value=config.DEFAULT_FREQ)
@@ -48,6 +68,10 @@ class CameraApp:
         
         self.v_trig_fps = tk.IntVar(value=config.DEFAULT_FPS)
         self.v_stack = tk.IntVar(value=config.DEFAULT_STACK)
+        self.v_stack_min = tk.IntVar(value=config.DEFAULT_STACK_MIN)
+        self.v_noise_target = tk.DoubleVar(value=config.DEFAULT_NOISE_TARGET)
+        self.v_adaptive = tk.BooleanVar(value=False)
+        self.v_drag_noise = tk.BooleanVar(value=False) # Preview drag sets the noise ROI instead of the capture ROI
         self.v_gain_ana = tk.DoubleVar(value=config.DEFAULT_ANA_GAIN)
         self.v_gain_dig = tk.DoubleVar(value=config.DEFAULT_DIG_GAIN)
         
@@ -55,22 +79,48 @@ class CameraApp:
         self.v_gx = tk.IntVar(value=0)
         self.v_gy = tk.IntVar(value=0)
         self.v_gamp = tk.DoubleVar(value=0.0)
+        self.v_abel = tk.BooleanVar(value=False)
+        self.v_abel_axis = tk.DoubleVar(value=0.5) # Symmetry axis, fraction of frame width
         
         self.v_show_hist = tk.BooleanVar(value=True)
+        self.v_hist_log = tk.BooleanVar(value=False)
+        self.v_hist_cum = tk.BooleanVar(value=False)
+        self.v_perf_overlay = tk.BooleanVar(value=False)
         self.v_live_interleave = tk.BooleanVar(value=True) 
         
         self.v_start = tk.IntVar(value=config.DEFAULT_START)
         self.v_end = tk.IntVar(value=config.DEFAULT_END)
         self.v_step = tk.IntVar(value=config.DEFAULT_STEP)
         self.v_video_fps = tk.IntVar(value=15) # Playback speed
+        self.v_video_ffv1 = tk.BooleanVar(value=config.VIDEO_FFV1)
+        self.v_lockin = tk.BooleanVar(value=False)
         
         self.v_save_raw = tk.BooleanVar(value=True)
         self.v_ctx = tk.BooleanVar(value=True)
+        self.v_sequencer = tk.BooleanVar(value=False)
         
         self.status = tk.StringVar(value="Ready")
+        self.preview_info = tk.StringVar(value="")
 
         self.setup_ui()
+        self.status.set("Initializing...")
+        self.btn_scan.config(state=tk.DISABLED)
+        threading.Thread(target=self.init_devices, daemon=True).start()
+        self.root.after(100, self.update_ui)
+
+    def init_devices(self):
+        # The pigpio connection and camera start overlap; the preview starts once both are up
+        def connect(): self.hw = hardware.HardwareManager()
+        t = threading.Thread(target=connect, daemon=True); t.start()
+        try:
+            self.camera = camera.CameraManager()
+            t.join()
+            if self.hw is None: raise RuntimeError("pigpio did not start")
+        except Exception as e: print(f"Init Error: {e}"); self.status.set(f"Init Error: {e}"); return
+        if self.closing: self.camera.close(); self.hw.cleanup(); return
+        self.ready.set()
         self.start_preview()
+        self.root.after(0, lambda: self.btn_scan.config(state=tk.NORMAL))
 
     def setup_ui(self):
         # Left: Video Only
@@ -78,6 +128,10 @@ class CameraApp:
         left.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         self.video_panel = tk.Label(left, bg="black")
         self.video_panel.pack(fill=tk.BOTH, expand=True)
+        self.video_panel.bind("<Configure>", self.on_panel_resize)
+        self.video_panel.bind("<Button-1>", self.on_click)
+        self.video_panel.bind("<B1-Motion>", self.on_drag)
+        self.video_panel.bind("<ButtonRelease-1>", self.on_release)
         
         # Right: Controls
         right = ttk.Frame(self.root, padding=10)
@@ -86,9 +140,12 @@ class CameraApp:
         m = tk.Menu(self.root); fm = tk.Menu(m, tearoff=0)
         fm.add_command(label="Save", command=self.save_settings)
         fm.add_command(label="Load", command=self.load_settings)
+        fm.add_separator()
+        fm.add_command(label="Run Experiment...", command=self.do_experiment)
         m.add_cascade(label="File", menu=fm); self.root.config(menu=m)
 
         ttk.Label(right, textvariable=self.status, foreground="blue").pack()
+        ttk.Label(right, textvariable=self.preview_info, foreground="gray").pack()
         
         # 1. Hardware
         grp_wave = ttk.LabelFrame(right, text="1. Hardware", padding=5)
@@ -115,10 +172,18 @@ class CameraApp:
         ttk.Entry(gf, textvariable=self.v_gx, width=3).pack(side=tk.LEFT)
         ttk.Entry(gf, textvariable=self.v_gy, width=3).pack(side=tk.LEFT)
         ttk.Entry(gf, textvariable=self.v_gamp, width=4).pack(side=tk.LEFT)
+        af = ttk.Frame(grp_img); af.pack()
+        ttk.Checkbutton(af, text="Abel Inversion, Axis", variable=self.v_abel).pack(side=tk.LEFT)
+        ttk.Entry(af, textvariable=self.v_abel_axis, width=5).pack(side=tk.LEFT)
         
-        ttk.Checkbutton(grp_img, text="Show Histogram", variable=self.v_show_hist).pack()
+        hf = ttk.Frame(grp_img); hf.pack()
+        ttk.Checkbutton(hf, text="Show Histogram", variable=self.v_show_hist).pack(side=tk.LEFT)
+        ttk.Checkbutton(hf, text="Log", variable=self.v_hist_log).pack(side=tk.LEFT)
+        ttk.Checkbutton(hf, text="Cumul.", variable=self.v_hist_cum).pack(side=tk.LEFT)
+        ttk.Checkbutton(grp_img, text="Perf Overlay", variable=self.v_perf_overlay).pack()
         ttk.Checkbutton(grp_img, text="Live Auto-Background", variable=self.v_live_interleave, command=lambda: self.update_hw()).pack()
         ttk.Button(grp_img, text="Capture Static BG", command=self.do_bg_cap).pack(fill=tk.X)
+        ttk.Button(grp_img, text="Clear ROI", command=self.clear_roi).pack(fill=tk.X)
         
         # 3. Automation
         grp_scan = ttk.LabelFrame(right, text="3. Automation", padding=5)
@@ -126,12 +191,19 @@ class CameraApp:
         self.add_ctrl(grp_scan, "Start", self.v_start, 0, 20000)
         self.add_ctrl(grp_scan, "End", self.v_end, 0, 20000)
         self.add_ctrl(grp_scan, "Step", self.v_step, 1, 1000)
-        self.add_ctrl(grp_scan, "Stack", self.v_stack, 1, 20)
+        self.add_ctrl(grp_scan, "Stack", self.v_stack, 1, 200)
+        self.add_ctrl(grp_scan, "Min Stack", self.v_stack_min, 2, 200)
+        self.add_ctrl(grp_scan, "Noise DN", self.v_noise_target, 0.05, 5.0)
         # Added Video FPS control
         self.add_ctrl(grp_scan, "Vid FPS", self.v_video_fps, 1, 60)
         
         ttk.Checkbutton(grp_scan, text="Save Raw Inputs", variable=self.v_save_raw).pack(anchor='w')
         ttk.Checkbutton(grp_scan, text="Save Context", variable=self.v_ctx).pack(anchor='w')
+        ttk.Checkbutton(grp_scan, text="HW Sequencer", variable=self.v_sequencer).pack(anchor='w')
+        ttk.Checkbutton(grp_scan, text="Adaptive Stack", variable=self.v_adaptive).pack(anchor='w')
+        ttk.Checkbutton(grp_scan, text="Drag Sets Noise ROI", variable=self.v_drag_noise).pack(anchor='w')
+        ttk.Checkbutton(grp_scan, text="Lossless Video (FFV1)", variable=self.v_video_ffv1).pack(anchor='w')
+        ttk.Checkbutton(grp_scan, text="Lock-in Maps", variable=self.v_lockin).pack(anchor='w')
         
         ttk.Button(right, text="Snapshot", command=self.do_snap).pack(fill=tk.X, pady=2)
         self.btn_scan = ttk.Button(right, text="Start Scan", command=self.do_scan); self.btn_scan.pack(fill=tk.X, pady=5)
@@ -148,25 +220,29 @@ class CameraApp:
         s.pack(side=tk.RIGHT, expand=True, fill=tk.X)
 
     def update_hw(self):
-        if self.scan_running: return
+        if self.scan_running or not self.ready.is_set(): return
         is_interleaved = self.v_live_interleave.get()
         self.hw.update_wave(self.v_delay.get(), self.v_exp.get(), self.v_led.get(), self.v_freq.get(), self.v_cycles.get(), self.v_trig_fps.get(), self.v_strobe.get(), True, is_interleaved)
 
     def start_preview(self):
         self.stop_event.clear()
         self.preview_thread = threading.Thread(target=self.run_preview, daemon=True)
-        self.preview_thread.start()
-        self.root.after(100, self.update_ui)
+        self.proc_thread = threading.Thread(target=self.run_preview_worker, daemon=True)
+        self.preview_thread.start(); self.proc_thread.start()
+
+    def stop_preview(self):
+        self.stop_event.set()
+        if self.preview_thread: self.preview_thread.join(2.0)
+        if self.proc_thread: self.proc_thread.join(2.0)
 
     def run_preview(self):
+        # Capture only: grabs frames (or sig/bg pairs) and hands the newest to run_preview_worker
         self.status.set("Starting Preview...")
         self.hw.stop(); self.update_hw()
-        cam = Picamera2()
-        cam.configure(cam.create_video_configuration(main={"size": (640, 480), "format": "RGB888"}))
-        cam.start()
-        cam.set_controls({"AeEnable": False, "AwbEnable": False})
+        cam = self.camera.use("preview", {"AeEnable": False, "AwbEnable": False}, settle=False)
         last_gain = -1; last_exp = -1; last_fps = -1
         was_interleaved = self.v_live_interleave.get()
+        pair_key = None; pairs = None
 
         while not self.stop_event.is_set():
             try:
@@ -178,177 +254,205 @@ class CameraApp:
                 g = self.v_gain_ana.get()
                 e = max(self.v_exp.get() + 100, 200)
                 if g != last_gain or e != last_exp:
-                    cam.set_controls({"AnalogueGain": g, "ExposureTime": e})
+                    self.camera.set_controls({"AnalogueGain": g, "ExposureTime": e}, settle=False)
                     last_gain = g; last_exp = e
                 
                 if is_interleaved:
-                    sig_frame = cam.capture_array("main")
-                    bg_frame = cam.capture_array("main")
-                    frame = sig_frame; bg_to_use = bg_frame
+                    # Pair frames by timestamp against the running wave, not by arrival order
+                    key = self.hw.current_key
+                    if key != pair_key:
+                        pair_key = key; pairs = None
+                        if key and key[-1]:
+                            pairer = camera.FramePairer(hardware.HardwareManager.wave_timing(key), camera.sensor_clock_ns() - config.PAIR_STALE_US * 1000)
+                            pairs = camera.frame_pairs(cam, camera.PREVIEW_SIZE, pairer)
+                    pair = next(pairs) if pairs else camera.discard(cam)
+                    if pair is None: continue
+                    frame, bg_to_use = pair
                 else:
                     if self.req_bg:
                         self.hw.update_wave(0, self.v_exp.get(), self.v_led.get(), 0, 0, curr_fps, False, True, False)
                         time.sleep(0.3)
-                        cam.capture_array("main") 
-                        frames = [cam.capture_array("main") for _ in range(5)]
+                        camera.discard(cam)
+                        frames = [camera.capture(cam, camera.PREVIEW_SIZE) for _ in range(5)]
                         self.bg_img = np.mean(np.array(frames), axis=0)
                         self.req_bg = False
                         self.update_hw()
-                    frame = cam.capture_array("main")
+                    with perf.probe("capture"): frame = camera.capture(cam, camera.PREVIEW_SIZE)
                     bg_to_use = self.bg_img
 
-                gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+                self.raw_slot.put((frame, bg_to_use))
+            except: time.sleep(0.01)
+        self.hw.stop()
+
+    def run_preview_worker(self):
+        # Processing: always takes the newest capture; stale ones were already replaced in raw_slot
+        proc = processor.FrameProcessor()
+        hist = processor.HistogramOverlay()
+        while not self.stop_event.is_set():
+            item = self.raw_slot.get(timeout=0.1)
+            if item is None: continue
+            try:
+                frame, bg_to_use = item
+                if frame.ndim == 2: gray = frame
+                else:
+                    with perf.probe("gray"): gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
                 bg_gray = None
                 if bg_to_use is not None:
                     if bg_to_use.shape[:2] != gray.shape[:2]: bg_to_use = cv2.resize(bg_to_use, (gray.shape[1], gray.shape[0]))
-                    bg_gray = cv2.cvtColor(bg_to_use.astype(np.uint8), cv2.COLOR_RGB2GRAY) if len(bg_to_use.shape)==3 else bg_to_use
+                    bg_gray = cv2.cvtColor(bg_to_use.astype(np.uint8), cv2.COLOR_RGB2GRAY) if len(bg_to_use.shape)==3 else bg_to_use.astype(np.uint8, copy=False)
 
                 ghost = (self.v_gx.get(), self.v_gy.get(), self.v_gamp.get())
-                processed = processor.process_frame(gray, bg_gray, self.v_gain_dig.get(), self.v_mode.get(), ghost)
+                abel_axis = int(self.v_abel_axis.get() * gray.shape[1]) if self.v_abel.get() else None
+                processed = proc.process(gray, bg_gray, self.v_gain_dig.get(), self.v_mode.get(), ghost, abel_axis)
                 
                 if self.v_show_hist.get():
-                    hist = processor.create_histogram(cv2.cvtColor(processed, cv2.COLOR_BGR2GRAY))
-                    h, w, _ = hist.shape
-                    processed[0:h, -w:] = hist
-                
-                with self.lock: self.latest_frame = cv2.cvtColor(processed, cv2.COLOR_BGR2RGB)
-            except: time.sleep(0.01)
-        cam.stop(); cam.close(); self.hw.stop()
+                    hist.set_view(self.v_hist_log.get(), self.v_hist_cum.get())
+                    hist.update(processed, frame)
+                    hist.draw(processed)
+
+                # Fit to the panel here so Tk only converts display-sized frames
+                ph, pw = processed.shape[:2]
+                scale = min(self.panel_size[0] / pw, self.panel_size[1] / ph)
+                size = (max(1, int(pw * scale)), max(1, int(ph * scale)))
+                if size != (pw, ph): processed = cv2.resize(processed, size, interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+                out = self.display.back_buffer((size[1], size[0], 3), np.uint8)
+                cv2.cvtColor(processed, cv2.COLOR_BGR2RGB, dst=out)
+                # Capture ROI in yellow, noise ROI in green
+                drag_noise = self.drag_roi and self.v_drag_noise.get()
+                for roi, color in ((self.drag_roi if self.drag_roi and not drag_noise else self.roi, (255, 255, 0)),
+                                   (self.drag_roi if drag_noise else self.noise_roi, (0, 255, 0))):
+                    if not roi: continue
+                    x, y, w, h = roi; oh, ow = out.shape[:2]
+                    cv2.rectangle(out, (int(x * ow), int(y * oh)), (int((x + w) * ow), int((y + h) * oh)), color, 1)
+                if self.v_perf_overlay.get():
+                    s = self.preview_stats()
+                    perf.draw_overlay(out, [f"FPS {perf.rate('preview.display'):.1f} | proc {perf.rate('preview.proc'):.1f}",
+                                            f"Dropped {s['dropped_captures'] + s['dropped_frames']}"],
+                                      ["capture", "gray", "proc.diff", "proc.ghost", "proc.gain", "proc.render", "histogram", "update_wave", "ui.repaint"])
+                self.display.publish(); perf.tick("preview.proc")
+            except Exception as e: print(f"Preview Error: {e}")
+
+    def on_panel_resize(self, e):
+        # Leave room for the label border so the image never pushes the panel wider
+        self.panel_size = (max(1, e.width - 4), max(1, e.height - 4))
+
+    def preview_stats(self):
+        s = self.display.stats()
+        return {"displayed": s["displayed"], "dropped_captures": self.raw_slot.dropped,
+                "dropped_frames": s["published"] - s["displayed"]}
 
     def update_ui(self):
-        with self.lock:
-            if self.latest_frame is not None:
-                img = Image.fromarray(self.latest_frame)
-                imgtk = ImageTk.PhotoImage(image=img)
+        # Repaint only when the worker published a new generation
+        gen, frame = self.display.read(self.display_gen)
+        if frame is not None:
+            self.display_gen = gen; self.display_size = (frame.shape[1], frame.shape[0])
+            with perf.probe("ui.repaint"):
+                imgtk = ImageTk.PhotoImage(image=Image.fromarray(frame))
                 self.video_panel.configure(image=imgtk)
                 self.video_panel.image = imgtk
-        if not self.stop_event.is_set(): self.root.after(30, self.update_ui)
+            perf.tick("preview.display")
+            if self.first_frame_s is None:
+                self.first_frame_s = time.perf_counter() - START; perf.record("startup.first_frame", self.first_frame_s)
+                print(f"First preview frame {self.first_frame_s:.2f}s after start")
+            if time.time() - self.info_t > 1.0:
+                self.info_t = time.time(); s = self.preview_stats()
+                self.preview_info.set(f"Shown {s['displayed']} | Dropped {s['dropped_captures'] + s['dropped_frames']}")
+        if not self.closing: self.root.after(15, self.update_ui)
 
     def do_bg_cap(self): self.req_bg = True
     def do_snap(self): self.launch_scan(True)
     def do_scan(self): self.launch_scan(False)
+    def do_experiment(self):
+        f = filedialog.askopenfilename(title="Experiment Plan", filetypes=[("JSON", "*.json")])
+        if not f: return
+        try: plan = experiment.load_plan(f)
+        except Exception as e: self.status.set(f"Plan Error: {e}"); return
+        # Unset keys come from the current settings; a rerun of the same plan resumes it
+        self.launch_scan(False, experiment.Experiment(plan, self.get_params()))
     
-    def launch_scan(self, single):
-        if self.scan_running: return
+    def launch_scan(self, single, exp=None):
+        if self.scan_running or not self.ready.is_set(): return
         self.scan_running = True
         self.btn_scan.config(state=tk.DISABLED)
-        threading.Thread(target=self.run_scan_thread, args=(single,)).start()
+        threading.Thread(target=self.run_scan_thread, args=(single, exp)).start()
 
-    def run_scan_thread(self, single_shot):
+    def run_scan_thread(self, single_shot, exp=None):
         try:
             self.status.set("Stopping Preview...")
-            self.stop_event.set()
-            if self.preview_thread: self.preview_thread.join(2.0)
-            self.stop_event.clear(); self.hw.stop(); time.sleep(0.5)
+            self.stop_preview()
+            self.stop_event.clear(); self.hw.stop()
             
-            ts = datetime.now().strftime('%Y%m%d_%H%M%S')
-            scan_dir = os.path.join("scans", ts)
-            if not os.path.exists(scan_dir): os.makedirs(scan_dir)
-
-            fps = self.v_trig_fps.get()
-
-            if self.v_ctx.get():
-                self.status.set("Taking Context (LED Off)...")
-                self.hw.update_wave(0, self.v_exp.get(), self.v_led.get(), 0, 0, fps, False, False, False)
-                cam = Picamera2()
-                cam.configure(cam.create_video_configuration(main={"size": (1440, 1080), "format": "RGB888"}))
-                max_safe_us = int(1000000/fps) - 10000
-                cam.set_controls({"ExposureTime": max_safe_us, "AnalogueGain": self.v_gain_ana.get(), "AeEnable": False, "AwbEnable": False})
-                cam.start(); time.sleep(1)
-                frames = [cam.capture_array("main") for _ in range(5)]
-                avg = np.mean(np.array(frames), axis=0)
-                processor.save_image(avg.astype(np.uint8), scan_dir, "ref_context.png")
-                cam.stop(); cam.close(); self.hw.stop(); time.sleep(0.2)
-
-            delays = [self.v_delay.get()] if single_shot else range(self.v_start.get(), self.v_end.get()+1, self.v_step.get())
-            
-            self.status.set("Init Scan...")
-            self.hw.update_wave(delays[0], self.v_exp.get(), self.v_led.get(), self.v_freq.get(), self.v_cycles.get(), fps, True, True, interleaved=True)
-            
-            cam = Picamera2()
-            cam.configure(cam.create_video_configuration(main={"size": (1440, 1080), "format": "RGB888"}))
-            cam.set_controls({
-                "ExposureTime": max(self.v_exp.get()+100, 200), 
-                "AnalogueGain": self.v_gain_ana.get(),
-                "AeEnable": False, "AwbEnable": False
-            })
-            cam.start(); time.sleep(1.0)
-            
-            for _ in range(4): cam.capture_array("main")
-            
-            stack = self.v_stack.get()
-            save_raw = self.v_save_raw.get()
-            
-            for i, d in enumerate(delays):
-                self.status.set(f"Capturing {d}us...")
-                self.hw.update_wave(d, self.v_exp.get(), self.v_led.get(), self.v_freq.get(), self.v_cycles.get(), fps, True, True, interleaved=True)
-                time.sleep(0.1)
-                
-                raw_frames = [cam.capture_array("main") for _ in range(stack * 2)]
-                sig_list = raw_frames[0::2]
-                bg_list = raw_frames[1::2]
-                
-                sig_avg = np.mean(np.array(sig_list, dtype=np.float32), axis=0)
-                bg_avg = np.mean(np.array(bg_list, dtype=np.float32), axis=0)
-                
-                s_gray = cv2.cvtColor(np.clip(sig_avg,0,255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
-                b_gray = cv2.cvtColor(np.clip(bg_avg,0,255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
-                
-                if save_raw:
-                    cv2.imwrite(os.path.join(scan_dir, f"raw_bg_{d:05d}.png"), b_gray)
-                    cv2.imwrite(os.path.join(scan_dir, f"raw_sig_{d:05d}.png"), s_gray)
-                
-                ghost = (self.v_gx.get(), self.v_gy.get(), self.v_gamp.get())
-                final = processor.process_frame(s_gray, b_gray, self.v_gain_dig.get(), self.v_mode.get(), ghost)
-                processor.save_image(final, scan_dir, f"frame_{d:05d}.png")
-                
-                if self.stop_event.is_set(): break
-
-            cam.stop(); cam.close(); self.hw.stop()
-            
-            # --- VIDEO GENERATION ---
-            if not single_shot:
-                self.status.set("Generating Video...")
-                try:
-                    # Ensure we pass the Video FPS value
-                    vid_fps = self.v_video_fps.get()
-                    vid = processor.generate_video(scan_dir, fps=vid_fps)
-                    if vid:
-                        self.status.set(f"Saved {os.path.basename(vid)}")
-                    else:
-                        self.status.set("Video failed: No images found")
-                except Exception as ve:
-                    print(f"Video Error: {ve}")
-                    self.status.set(f"Video Error: {ve}")
+            if exp:
+                n = exp.run(self.hw, self.camera, status=self.status.set, stop_event=self.stop_event)
+                self.status.set(f"Experiment: {n} runs done, {len(exp.pending())} left")
             else:
-                self.status.set("Snapshot Saved")
+                engine = scan.ScanEngine(self.hw, self.get_params(), status=self.status.set, stop_event=self.stop_event, camera=self.camera)
+                engine.run(single_shot)
 
         except Exception as e: print(e); self.status.set(f"Error: {e}")
         finally:
-            self.scan_running = False; self.hw.stop(); self.stop_event.clear()
-            self.preview_thread = threading.Thread(target=self.run_preview, daemon=True)
-            self.preview_thread.start()
+            self.scan_running = False; self.hw.stop()
+            self.start_preview()
             self.root.after(0, lambda: self.btn_scan.config(state=tk.NORMAL))
-            self.root.after(100, self.update_ui)
+
+    def get_params(self):
+        p = {k: v.get() for k, v in vars(self).items() if k.startswith("v_")}
+        p["v_roi"] = list(self.roi) if self.roi else None
+        p["v_noise_roi"] = list(self.noise_roi) if self.noise_roi else None
+        return p
 
     def save_settings(self):
         f = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
         if not f: return
-        data = {k: getattr(self, k).get() for k in ["v_freq", "v_cycles", "v_delay", "v_gain_dig", "v_gain_ana", "v_gx", "v_gy", "v_gamp", "v_trig_fps", "v_stack", "v_start", "v_end", "v_step"]}
+        data = {k: getattr(self, k).get() for k in ["v_freq", "v_cycles", "v_delay", "v_gain_dig", "v_gain_ana", "v_gx", "v_gy", "v_gamp", "v_abel", "v_abel_axis", "v_trig_fps", "v_stack", "v_stack_min", "v_noise_target", "v_adaptive", "v_start", "v_end", "v_step"]}
+        data["v_roi"] = list(self.roi) if self.roi else None
+        data["v_noise_roi"] = list(self.noise_roi) if self.noise_roi else None
         with open(f, 'w') as file: json.dump(data, file)
     def load_settings(self):
         f = filedialog.askopenfilename(filetypes=[("JSON", "*.json")]); 
         if not f: return
         with open(f, 'r') as file: d = json.load(file)
+        if "v_roi" in d: roi = d.pop("v_roi"); self.roi = tuple(roi) if roi else None
+        if "v_noise_roi" in d: roi = d.pop("v_noise_roi"); self.noise_roi = tuple(roi) if roi else None
         for k, v in d.items(): 
             if hasattr(self, k): getattr(self, k).set(v)
         self.update_hw()
-    def on_click(self, e): pass # Click logic removed for clean version
-    def on_drag(self, e): pass
-    def on_release(self, e): pass
+    def panel_to_frame(self, e):
+        # The image is centred in the label; returns the event position as frame fractions
+        fw, fh = self.display_size
+        ox = (self.video_panel.winfo_width() - fw) / 2; oy = (self.video_panel.winfo_height() - fh) / 2
+        return min(1.0, max(0.0, (e.x - ox) / fw)), min(1.0, max(0.0, (e.y - oy) / fh))
+
+    def on_click(self, e):
+        self.drag_start = self.panel_to_frame(e); self.drag_roi = None
+
+    def on_drag(self, e):
+        if not self.drag_start: return
+        (x0, y0), (x1, y1) = self.drag_start, self.panel_to_frame(e)
+        self.drag_roi = (min(x0, x1), min(y0, y1), abs(x1 - x0), abs(y1 - y0))
+
+    def on_release(self, e):
+        self.on_drag(e)
+        roi, self.drag_roi, self.drag_start = self.drag_roi, None, None
+        # A plain click (or a tiny box) keeps the current ROI
+        if not roi or roi[2] < 0.02 or roi[3] < 0.02: return
+        if self.v_drag_noise.get():
+            self.noise_roi = roi
+            x, y, w, h = camera.roi_within(camera.SCAN_SIZE, roi)
+            self.status.set(f"Noise ROI {w}x{h} at ({x}, {y})"); return
+        self.roi = roi
+        x, y, w, h = camera.roi_rect(camera.SCAN_SIZE, roi)
+        self.status.set(f"ROI {w}x{h} at ({x}, {y})")
+
+    def clear_roi(self):
+        # Clears the ROI the drag currently sets
+        if self.v_drag_noise.get(): self.noise_roi = None; self.status.set("Noise ROI cleared")
+        else: self.roi = None; self.status.set("ROI cleared")
 
     def on_close(self):
-        self.stop_event.set(); self.hw.cleanup(); self.root.destroy()
+        self.closing = True; self.stop_preview()
+        if self.ready.is_set(): self.camera.close(); self.hw.cleanup()
+        self.root.destroy()
 
 if __name__ == "__main__":
     root = tk.Tk(); app = CameraApp(root)
@@ -0,0 +1,108 @@
+# perf.py
+# Lightweight timing probes. Each named stage keeps its last PERF_RING_SIZE
+# durations in a ring buffer, so percentiles always describe recent behaviour.
+#   with perf.probe("capture"): frame = cam.capture_array("main")
+#   @perf.probe("update_wave")
+#   def update_wave(...): ...
+import contextlib
+import json
+import os
+import threading
+import time
+import cv2
+import numpy as np
+
+import config
+
+ENABLED = True
+
+class Ring:
+    """Fixed-size ring of float samples with a total count."""
+    def __init__(self, size=config.PERF_RING_SIZE):
+        self.buf = np.zeros(size, np.float64)
+        self.n = 0
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        with self.lock:
+            self.buf[self.n % len(self.buf)] = value
+            self.n += 1
+
+    def values(self):
+        with self.lock:
+            if self.n <= len(self.buf): return self.buf[:self.n].copy()
+            i = self.n % len(self.buf)
+            return np.concatenate([self.buf[i:], self.buf[:i]])
+
+_lock = threading.Lock()
+_stages = {}
+_events = {}
+_counters = {}
+
+def _ring(table, name):
+    r = table.get(name)
+    if r is None:
+        with _lock: r = table.setdefault(name, Ring())
+    return r
+
+def record(name, seconds):
+    if ENABLED: _ring(_stages, name).add(seconds)
+
+@contextlib.contextmanager
+def probe(name):
+    """Times the block (or, used as a decorator, each call) under `name`."""
+    if not ENABLED:
+        yield; return
+    t = time.perf_counter()
+    try: yield
+    finally: _ring(_stages, name).add(time.perf_counter() - t)
+
+def tick(name):
+    """Marks an event (a displayed frame, a finished delay) for rate()."""
+    if ENABLED: _ring(_events, name).add(time.perf_counter())
+
+def count(name, n=1):
+    with _lock: _counters[name] = _counters.get(name, 0) + n
+
+def rate(name):
+    """Events per second over the recent ring of ticks."""
+    r = _events.get(name)
+    if r is None: return 0.0
+    t = r.values()
+    return (len(t) - 1) / (t[-1] - t[0]) if len(t) > 1 and t[-1] > t[0] else 0.0
+
+def stats(name):
+    r = _stages.get(name)
+    if r is None or r.n == 0: return None
+    v = r.values() * 1000.0
+    p50, p95 = np.percentile(v, [50, 95])
+    return {"count": r.n, "mean_ms": float(v.mean()), "p50_ms": float(p50), "p95_ms": float(p95), "max_ms": float(v.max())}
+
+def snapshot():
+    return {"stages": {k: stats(k) for k in sorted(_stages)},
+            "rates": {k: rate(k) for k in sorted(_events)},
+            "counters": dict(_counters)}
+
+def reset():
+    with _lock: _stages.clear(); _events.clear(); _counters.clear()
+
+def write_json(folder, extra=None, filename="perf.json"):
+    data = snapshot()
+    data["time"] = time.strftime('%Y-%m-%d %H:%M:%S')
+    if extra: data.update(extra)
+    path = os.path.join(folder, filename)
+    with open(path, "w") as f: json.dump(data, f, indent=1)
+    return path
+
+def draw_overlay(img, lines=(), stages=None, origin=(8, 18)):
+    """Writes the given lines, then p50/p95 of each stage, onto img (in place)."""
+    text = list(lines)
+    for name in (stages if stages is not None else sorted(_stages)):
+        s = stats(name)
+        if s: text.append(f"{name}: {s['p50_ms']:.1f}/{s['p95_ms']:.1f} ms")
+    x, y = origin
+    for line in text:
+        cv2.putText(img, line, (x, y), cv2.FONT_HERSHEY_PLAIN, 1.0, (0, 0, 0), 3)
+        cv2.putText(img, line, (x, y), cv2.FONT_HERSHEY_PLAIN, 1.0, (255, 255, 255), 1)
+        y += 16
+    return img
@@ -0,0 +1,63 @@
+# preview.py
+# Hand-off primitives for the live preview: capture -> processing -> Tk.
+import threading
+import numpy as np
+
+class LatestSlot:
+    """One-item mailbox between two threads. put() replaces an unread item,
+    so the reader always gets the newest one; replaced items count as dropped."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if self.item is not None: self.dropped += 1
+            self.item = item
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Newest item, or None if nothing arrived within timeout."""
+        with self.cond:
+            if self.item is None: self.cond.wait(timeout)
+            item, self.item = self.item, None
+            return item
+
+class TripleBuffer:
+    """Three reusable frame buffers: the writer fills `back`, publish() swaps it
+    with the pending slot, and the reader swaps the pending slot to the front.
+    Neither side waits on the other and the reader never sees a half-written frame.
+    Each publish bumps `generation` so the reader can skip repaints when nothing changed."""
+    def __init__(self):
+        self.slots = [None, None, None]
+        self.back, self.pending, self.front = 0, 1, 2
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.fresh = False
+        self.published = 0
+        self.displayed = 0
+
+    def back_buffer(self, shape, dtype):
+        """The writer's buffer, reallocated only when the frame size changes."""
+        buf = self.slots[self.back]
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = self.slots[self.back] = np.empty(shape, dtype)
+        return buf
+
+    def publish(self):
+        with self.lock:
+            self.back, self.pending = self.pending, self.back
+            self.generation += 1; self.fresh = True
+            self.published += 1
+
+    def read(self, last_generation):
+        """(generation, frame) if a newer frame was published, else (last_generation, None)."""
+        with self.lock:
+            if not self.fresh or self.generation == last_generation: return last_generation, None
+            self.front, self.pending = self.pending, self.front
+            self.fresh = False; self.displayed += 1
+            return self.generation, self.slots[self.front]
+
+    def stats(self):
+        return {"published": self.published, "displayed": self.displayed}
@@ -1,11 +1,14 @@
 import cv2
+import functools
 import numpy as np
 import os
-import matplotlib
-# Force Agg backend to prevent GUI thread conflicts
-matplotlib.use('Agg') 
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import abel
+import config
+import perf
+import render3d
 
 def apply_ghost_removal(img, dx, dy, amp):
     if amp == 0.0 or (dx == 0 and dy == 0): return img
@@ -14,18 +17,86 @@ def apply_ghost_removal(img, dx, dy, amp):
     ghost = cv2.warpAffine(img, M, (cols, rows))
     return img - (ghost * amp)
 
+HIST_H, HIST_W = 100, 256
+SAT_STRIP_H = 16
+
+@functools.lru_cache(maxsize=1)
+def _hist_gradient():
+    """Line colour per bin, (255-i, i, 100) BGR as the original per-segment colours."""
+    i = np.arange(HIST_W, dtype=np.int32)
+    row = np.stack([255 - i, i, np.full_like(i, 100)], axis=-1).astype(np.uint8)
+    return np.broadcast_to(row, (HIST_H, HIST_W, 3))
+
+def _plot_hist(hist, out, log=False, cumulative=False):
+    """Draws a 256-bin histogram into out (HIST_H x HIST_W x 3) with one polylines call."""
+    hist = np.asarray(hist, np.float64).ravel()
+    if cumulative: hist = np.cumsum(hist)
+    if log: hist = np.log1p(hist)
+    top = hist.max()
+    ys = HIST_H - (hist * (HIST_H / top) if top > 0 else hist)
+    pts = np.stack([np.arange(HIST_W), np.clip(ys, 0, HIST_H - 1)], axis=-1).astype(np.int32)
+    mask = np.zeros((HIST_H, HIST_W), np.uint8)
+    cv2.polylines(mask, [pts], False, 255, 1)
+    out[:] = 0
+    np.copyto(out, _hist_gradient(), where=mask[..., None].astype(bool))
+    return out
+
 def create_histogram(img):
     if len(img.shape) == 3: img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    hist = cv2.calcHist([img], [0], None, [256], [0, 256])
-    h_h, h_w = 100, 256
-    hist_img = np.zeros((h_h, h_w, 3), dtype=np.uint8)
-    cv2.normalize(hist, hist, 0, h_h, cv2.NORM_MINMAX)
-    for i in range(1, 256):
-        pt1 = (i - 1, h_h - int(hist[i - 1]))
-        pt2 = (i, h_h - int(hist[i]))
-        col = (255 - i, i, 100)
-        cv2.line(hist_img, pt1, pt2, col, 1)
-    return hist_img
+    hist = np.bincount(img.ravel(), minlength=256)
+    return _plot_hist(hist, np.empty((HIST_H, HIST_W, 3), np.uint8))
+
+class HistogramOverlay:
+    """Histogram inset for the preview, redrawn at most rate_hz times a second.
+
+    Bins a strided view of the displayed frame; saturation counters come from
+    the raw signal so they reflect the sensor, not the display gain.
+    """
+    def __init__(self, rate_hz=config.HIST_RATE_HZ, stride=config.HIST_STRIDE):
+        self.period = 1.0 / rate_hz if rate_hz > 0 else 0.0
+        self.stride = stride
+        self.log = False
+        self.cumulative = False
+        self.img = np.zeros((HIST_H + SAT_STRIP_H, HIST_W, 3), np.uint8)
+        self.last_t = -1e9
+        self.saturated = 0.0  # fraction of raw pixels at 255
+        self.black = 0.0      # fraction of raw pixels at 0
+
+    def set_view(self, log, cumulative):
+        if (log, cumulative) != (self.log, self.cumulative):
+            self.log, self.cumulative = log, cumulative
+            self.last_t = -1e9
+
+    def update(self, display, raw=None, now=None):
+        """Recomputes the inset if it is due. Returns True when it was redrawn."""
+        now = time.perf_counter() if now is None else now
+        if now - self.last_t < self.period: return False
+        self.last_t = now
+        with perf.probe("histogram"): self._redraw(display, raw)
+        return True
+
+    def _redraw(self, display, raw):
+        s = self.stride
+        view = np.ascontiguousarray(display[::s, ::s])
+        if view.ndim == 3: view = cv2.cvtColor(view, cv2.COLOR_BGR2GRAY)
+        _plot_hist(np.bincount(view.ravel(), minlength=256), self.img[:HIST_H], self.log, self.cumulative)
+
+        strip = self.img[HIST_H:]; strip[:] = 0
+        if raw is not None:
+            r = raw[::s, ::s]
+            if r.ndim == 3: r = r.max(axis=-1)
+            n = max(1, r.size)
+            self.saturated = np.count_nonzero(r >= 255) / n
+            self.black = np.count_nonzero(r == 0) / n
+            col = (0, 0, 255) if self.saturated > 0.001 else (200, 200, 200)
+            cv2.putText(strip, f"sat {self.saturated*100:.2f}%  blk {self.black*100:.2f}%", (2, 12),
+                        cv2.FONT_HERSHEY_PLAIN, 0.9, col, 1)
+
+    def draw(self, frame):
+        """Pastes the inset into the top-right corner of frame (in place)."""
+        h = min(self.img.shape[0], frame.shape[0]); w = min(self.img.shape[1], frame.shape[1])
+        frame[0:h, -w:] = self.img[:h, -w:]
+        return frame
 
 def process_frame(signal, bg, gain, mode, ghost_params=None):
     if bg is None or mode == "Raw":
@@ -103,71 +174,387 @@ def process_frame(signal, bg, gain, mode, ghost_params=None):
 
     return final_bgr
 
-def render_3d_frame(cv_img, step_down=4, elev=30, azim=-60, axis_x=0, mode="Topography"):
-    if len(cv_img.shape) == 3: gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
-    else: gray = cv_img
-    h, w = gray.shape
-    fig = plt.figure(figsize=(10, 6), dpi=80)
-    ax = fig.add_subplot(111, projection='3d')
-
-    if mode == "Stacked Slices":
-        col_idx = max(0, min(axis_x, w-1)); roi = gray[:, col_idx:]; rh, rw = roi.shape
-        num_slices = 30; slice_step = max(1, rh // num_slices); theta = np.linspace(0, 2*np.pi, 50)
-        for y in range(0, rh, slice_step):
-            row_data = roi[y, :][::step_down]
-            dmin, dmax = row_data.min(), row_data.max()
-            norm_row = (row_data - dmin) / (dmax - dmin) if dmax - dmin > 10 else row_data / 255.0
-            r = np.arange(len(row_data)); R, Theta = np.meshgrid(r, theta)
-            X = R * np.cos(Theta); Y = R * np.sin(Theta); Z = np.full_like(X, rh - y) 
-            intensity = np.tile(norm_row, (len(theta), 1))
-            colors = plt.cm.jet(intensity); colors[:, :, 3] = np.power(intensity, 3) * 0.9 + 0.1
-            ax.plot_surface(X, Y, Z, facecolors=colors, rstride=1, cstride=1, shade=False)
-        ax.set_box_aspect((1, 1, 3))
-    elif mode == "Revolution":
-        col_idx = max(0, min(axis_x, w-1)); start_c = max(0, col_idx-2); end_c = min(w, col_idx+3)
-        slice_data = np.mean(gray[:, start_c:end_c], axis=1)[::step_down]
-        d_min, d_max = slice_data.min(), slice_data.max()
-        norm_data = (slice_data - d_min) / (d_max - d_min) if dmax > d_min else slice_data/255.0
-        z = np.arange(len(slice_data)); theta = np.linspace(0, 2*np.pi, 60); Z, Theta = np.meshgrid(z, theta)
-        R = 10 + (np.tile(norm_data, (len(theta), 1)) * 15.0)
-        X = R * np.cos(Theta); Y = R * np.sin(Theta)
-        color_matrix = np.tile(norm_data, (len(theta), 1))
-        surf = ax.plot_surface(X, Y, Z, facecolors=plt.cm.inferno(color_matrix), shade=False); ax.set_box_aspect((1, 1, 3))
-    else:
-        start_col = max(0, min(axis_x, w-1)); roi = gray[:, start_col:]; down = roi[::step_down, ::step_down]
-        f_img = down.astype(np.float32); f_bg = cv2.GaussianBlur(f_img, (31, 31), 0); z_data = f_img - f_bg
-        dmin, dmax = z_data.min(), z_data.max()
-        norm_down = (z_data - dmin) / (d_max - d_min) if dmax > dmin else (z_data - dmin)
-        X, Y = np.meshgrid(np.arange(down.shape[1]), np.arange(down.shape[0]))
-        surf = ax.plot_surface(X, Y, z_data, facecolors=plt.cm.jet(norm_down), linewidth=0, antialiased=False); ax.set_zlim(-50, 50); ax.set_box_aspect((4, 3, 0.4))
-
-    ax.axis('off'); ax.view_init(elev=elev, azim=azim)
-    fig.canvas.draw(); buf = fig.canvas.buffer_rgba()
-    data = np.frombuffer(buf, dtype=np.uint8)
-    w_can, h_can = fig.canvas.get_width_height(); data = data.reshape((h_can, w_can, 4)); plt.close(fig)
-    return cv2.cvtColor(data, cv2.COLOR_RGBA2BGR)
-
-def generate_video(scan_dir, fps=10, render_3d=False, elev=30, azim=-60, axis_x=0, mode_3d="Topography"):
+LUT_DIFF_SIZE = 512  # quantized amplified diff, -256..255
+
+def build_lut(mode):
+    """BGR lookup table for a display mode, indexed by quantized diff + 256.
+
+    Enhanced and Colorize also depend on the background, so their tables are
+    (256 * 512, 3) and indexed by bg * 512 + q. Dig Gain is applied when the
+    diff is quantized, so tables never need rebuilding when it changes.
+    """
+    d = np.arange(-256, 256, dtype=np.float32)
+    if "Abs Diff" in mode:
+        v = np.clip(np.abs(d), 0, 255).astype(np.uint8)
+        return np.repeat(v[:, None], 3, axis=1)
+    if "Heatmap" in mode:
+        cmap = cv2.COLORMAP_JET
+        if "Inferno" in mode: cmap = cv2.COLORMAP_INFERNO
+        elif "Viridis" in mode: cmap = cv2.COLORMAP_VIRIDIS
+        ramp = np.clip(d + 127, 0, 255).astype(np.uint8)
+        return cv2.applyColorMap(ramp.reshape(-1, 1), cmap).reshape(-1, 3)
+
+    b = np.arange(256, dtype=np.float32)[:, None]
+    if "Enhanced" in mode:
+        v = np.clip(b + d, 0, 255).astype(np.uint8).reshape(-1, 1)
+        return np.repeat(v, 3, axis=1)
+    if "Colorize" in mode:
+        base = b * 0.4
+        lut = np.empty((256, LUT_DIFF_SIZE, 3), np.uint8)
+        lut[..., 0] = np.clip(base - np.minimum(d, 0), 0, 255)
+        lut[..., 1] = np.clip(base, 0, 255)
+        lut[..., 2] = np.clip(base + np.maximum(d, 0), 0, 255)
+        return lut.reshape(-1, 3)
+    return None
+
+class FrameProcessor:
+    """Reusable, allocation-free version of process_frame.
+
+    Work buffers are allocated once per frame shape and reused, so the returned
+    image is owned by the processor and is overwritten by the next call.
+
+    The flicker drift is estimated on a reduced pyramid level (pyrDown, blur,
+    pyrUp) instead of a full-frame sigma=30 blur. That drift term differs from
+    process_frame's by about 3% of the drift amplitude (before Dig Gain; 0.17 DN
+    at 5 DN drift, 0.66 DN at 20 DN with drift_levels=2, a third of that with 1),
+    and the error is multiplied by Dig Gain: at gain 25 grey modes differ by up
+    to 5 levels with 5 DN drift. drift_levels=0 runs the full-resolution blur;
+    then the only difference is rounding the amplified diff (process_frame
+    truncates), i.e. within 1 grey level or one colormap LUT entry.
+    """
+    def __init__(self, drift_levels=2, drift_sigma=30):
+        self.drift_levels = drift_levels
+        self.drift_sigma = drift_sigma
+        self.shape = None
+        self.luts = {}
+
+    def _alloc(self, shape):
+        h, w = shape
+        self.diff = np.empty(shape, np.float32)
+        self.drift = np.empty(shape, np.float32)
+        self.tmp = np.empty(shape, np.float32)
+        self.q = np.empty(shape, np.uint16)
+        self.idx = np.empty(shape, np.uint32)
+        self.out = np.empty((h, w, 3), np.uint8)
+        # Pyramid buffers for the reduced-resolution drift estimate
+        self.pyr = []
+        for _ in range(self.drift_levels):
+            h, w = (h + 1) // 2, (w + 1) // 2
+            self.pyr.append(np.empty((h, w), np.float32))
+        self.pyr_blur = np.empty_like(self.pyr[-1]) if self.pyr else None
+        # Each pyramid level adds roughly unit variance at its own scale; take it
+        # out of the blur so the overall low-pass matches sigma=drift_sigma.
+        pyr_var = 2 * sum(4 ** l for l in range(self.drift_levels))
+        self.pyr_sigma = np.sqrt(max(self.drift_sigma ** 2 - pyr_var, 1.0)) / (2 ** self.drift_levels)
+        self.shape = shape
+
+    def _estimate_drift(self):
+        if not self.pyr:
+            cv2.GaussianBlur(self.diff, (0, 0), sigmaX=self.drift_sigma, sigmaY=self.drift_sigma, dst=self.drift)
+            return
+        src = self.diff
+        for buf in self.pyr:
+            cv2.pyrDown(src, dst=buf, dstsize=(buf.shape[1], buf.shape[0]))
+            src = buf
+        cv2.GaussianBlur(src, (0, 0), sigmaX=self.pyr_sigma, sigmaY=self.pyr_sigma, dst=self.pyr_blur)
+        src = self.pyr_blur
+        for buf in reversed([self.drift] + self.pyr[:-1]):
+            cv2.pyrUp(src, dst=buf, dstsize=(buf.shape[1], buf.shape[0]))
+            src = buf
+
+    def highpass(self, signal, bg):
+        """(signal - bg) minus its flicker drift, in a buffer owned by the processor."""
+        if signal.shape != self.shape: self._alloc(signal.shape)
+        with perf.probe("proc.diff"):
+            np.subtract(signal, bg, out=self.diff, dtype=np.float32)
+            self._estimate_drift()
+            np.subtract(self.diff, self.drift, out=self.diff)
+        return self.diff
+
+    def process(self, signal, bg, gain, mode, ghost_params=None, abel_axis=None, abel_ds=config.ABEL_DS):
+        if bg is None or mode == "Raw":
+            if len(signal.shape) == 2: return cv2.cvtColor(signal, cv2.COLOR_GRAY2BGR)
+            return signal
+
+        if bg.shape != signal.shape: bg = cv2.resize(bg, (signal.shape[1], signal.shape[0]))
+        # 1. Difference + flicker high-pass
+        diff = self.highpass(signal, bg)
+        tmp, out = self.tmp, self.out
+
+        # 2. De-Ghosting
+        if ghost_params:
+            dx, dy, amp = ghost_params
+            if amp != 0.0 and (dx != 0 or dy != 0):
+                with perf.probe("proc.ghost"):
+                    M = np.float32([[1, 0, dx], [0, 1, dy]])
+                    cv2.warpAffine(diff, M, (diff.shape[1], diff.shape[0]), dst=tmp)
+                    cv2.scaleAdd(tmp, -amp, diff, dst=diff)
+
+        # 2b. Abel inversion of every row about column abel_axis (axisymmetric flows)
+        if abel_axis is not None:
+            with perf.probe("proc.abel"):
+                field = abel.invert(diff, abel_axis, abel_ds)
+                if field.shape == diff.shape: np.copyto(diff, field)
+                else: cv2.resize(field, (diff.shape[1], diff.shape[0]), dst=diff, interpolation=cv2.INTER_LINEAR)
+
+        # 3. Amplify and quantize once: q = round(diff * gain) in [-256, 255], stored as q + 256
+        with perf.probe("proc.gain"):
+            np.multiply(diff, gain, out=diff)
+            np.clip(diff, -256, 255, out=diff); np.add(diff, 256.5, out=diff)
+            np.copyto(self.q, diff, casting='unsafe')
+
+        # 4. Render through the cached LUT for this mode
+        with perf.probe("proc.render"):
+            if mode not in self.luts: self.luts[mode] = build_lut(mode)
+            lut = self.luts[mode]
+            if lut is None:
+                cv2.cvtColor(signal.astype(np.uint8), cv2.COLOR_GRAY2BGR, dst=out)
+            elif len(lut) == LUT_DIFF_SIZE:
+                np.take(lut, self.q, axis=0, out=out, mode='clip')
+            else:
+                # 2D table indexed by (background, diff)
+                np.copyto(self.idx, bg, casting='unsafe')
+                np.multiply(self.idx, LUT_DIFF_SIZE, out=self.idx); np.add(self.idx, self.q, out=self.idx)
+                np.take(lut, self.idx, axis=0, out=out, mode='clip')
+
+        return out
+
+class StackAccumulator:
+    """Running per-pixel mean and variance (Welford) of a frame stack.
+
+    Frames are converted to gray and folded in as soon as they are captured, so
+    memory stays at a few frame-sized buffers whatever the stack depth.
+    """
+    def __init__(self):
+        self.n = 0
+        self.shape = None
+        self.gray = None
+
+    def reset(self):
+        self.n = 0
+
+    def _alloc(self, shape):
+        self.mean = np.empty(shape, np.float32)
+        self.m2 = np.empty(shape, np.float32)
+        self.delta = np.empty(shape, np.float32)
+        self.mean_byte = np.empty(shape, np.uint8)
+        self.shape = shape
+
+    def add(self, frame):
+        if frame.ndim == 3:
+            if self.gray is None or self.gray.shape != frame.shape[:2]: self.gray = np.empty(frame.shape[:2], np.uint8)
+            with perf.probe("gray"): frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=self.gray)
+        if frame.shape != self.shape: self._alloc(frame.shape); self.n = 0
+
+        self.n += 1
+        if self.n == 1:
+            np.copyto(self.mean, frame, casting='unsafe'); self.m2.fill(0)
+            return
+        # delta = x - mean; mean += delta / n; m2 += delta * (x - new_mean) = delta^2 * (n-1) / n
+        np.subtract(frame, self.mean, out=self.delta, dtype=np.float32)
+        cv2.scaleAdd(self.delta, 1.0 / self.n, self.mean, dst=self.mean)
+        np.multiply(self.delta, self.delta, out=self.delta)
+        cv2.scaleAdd(self.delta, (self.n - 1) / self.n, self.m2, dst=self.m2)
+
+    def mean_u8(self):
+        np.add(self.mean, 0.5, out=self.delta); np.clip(self.delta, 0, 255, out=self.delta)
+        np.copyto(self.mean_byte, self.delta, casting='unsafe')
+        return self.mean_byte
+
+    def variance(self):
+        return self.m2 / max(1, self.n - 1)
+
+    def detach(self):
+        """Hand the finished stack to the caller and start a fresh one on the next add()."""
+        done = StackAccumulator()
+        done.n, done.shape = self.n, self.shape
+        done.mean, done.m2, done.delta, done.mean_byte = self.mean, self.m2, self.delta, self.mean_byte
+        self.n = 0; self.shape = None
+        return done
+
+class AdaptiveStack:
+    """Decides when a delay has stacked enough (signal, background) pairs.
+
+    Each pair's flicker high-passed difference inside the ROI is folded into a
+    StackAccumulator; the delay is done once the standard error of the stacked
+    difference, RMS over the ROI, is at most `target` DN, within [min_n, max_n]
+    pairs. roi is (x, y, w, h) in pixels of the frames passed to crop(), or None
+    for their central half (see ScanEngine.noise_roi for how scans choose it).
+    """
+    def __init__(self, target, min_n, max_n, roi=None):
+        self.target = target
+        self.max_n = max(1, int(max_n))
+        self.min_n = min(max(2, int(min_n)), self.max_n)
+        self.roi = roi
+        self.proc = FrameProcessor()
+        self.acc = StackAccumulator()
+
+    def crop(self, frame):
+        h, w = frame.shape[:2]
+        x, y, rw, rh = self.roi or (w // 4, h // 4, w // 2, h // 2)
+        return frame[y:y+rh, x:x+rw]
+
+    def add(self, sig_crop, bg_crop):
+        """Adds one pair, both already passed through crop()."""
+        with perf.probe("adaptive"): self.acc.add(self.proc.highpass(sig_crop, bg_crop))
+
+    @property
+    def n(self): return self.acc.n
+
+    def noise(self):
+        if self.acc.n < 2: return float("inf")
+        return float(np.sqrt(self.acc.variance().mean() / self.acc.n))
+
+    def done(self):
+        return self.acc.n >= self.max_n or (self.acc.n >= self.min_n and self.noise() <= self.target)
+
+    def reset(self):
+        self.acc.reset()
+
+def noise_variance(sig_acc, bg_acc):
+    """Per-pixel variance of the stacked (signal - background) difference."""
+    return sig_acc.variance() / max(1, sig_acc.n) + bg_acc.variance() / max(1, bg_acc.n)
+
+def noise_map(sig_acc, bg_acc):
+    """Per-pixel standard error of the stacked (signal - background) difference."""
+    return np.sqrt(noise_variance(sig_acc, bg_acc))
+
+@functools.lru_cache(maxsize=1)
+def _matplotlib():
+    """Imports matplotlib on the first quality 3D render; it roughly doubles startup
+    otherwise. Returns (colormaps, Figure, FigureCanvasAgg)."""
+    import matplotlib
+    # Force Agg backend to prevent GUI thread conflicts
+    matplotlib.use('Agg')
+    from matplotlib import cm
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from mpl_toolkits.mplot3d import Axes3D  # registers the '3d' projection
+    return cm, Figure, FigureCanvasAgg
+
+class Renderer3D:
+    """Keeps one figure and 3D axes alive and only replaces the surface per frame."""
+    def __init__(self):
+        self.cm, Figure, FigureCanvasAgg = _matplotlib()
+        self.fig = Figure(figsize=(10, 6), dpi=80)
+        FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(111, projection='3d')
+        self.mode = None
+
+    def render(self, cv_img, step_down=4, elev=30, azim=-60, axis_x=0, mode="Topography"):
+        if len(cv_img.shape) == 3: gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
+        else: gray = cv_img
+        h, w = gray.shape
+        ax = self.ax
+        if mode != self.mode: ax.cla(); self.mode = mode
+        else:
+            for c in list(ax.collections): c.remove()
+
+        if mode == "Stacked Slices":
+            col_idx = max(0, min(axis_x, w-1)); roi = gray[:, col_idx:]; rh, rw = roi.shape
+            num_slices = 30; slice_step = max(1, rh // num_slices); theta = np.linspace(0, 2*np.pi, 50)
+            # All slices go into one surface; the quads bridging consecutive slices are made transparent
+            xs, ys, zs, cs = [], [], [], []
+            for y in range(0, rh, slice_step):
+                row_data = roi[y, :][::step_down]
+                dmin, dmax = row_data.min(), row_data.max()
+                norm_row = (row_data - dmin) / (dmax - dmin) if dmax - dmin > 10 else row_data / 255.0
+                r = np.arange(len(row_data)); R, Theta = np.meshgrid(r, theta)
+                xs.append(R * np.cos(Theta)); ys.append(R * np.sin(Theta)); zs.append(np.full(R.shape, rh - y, dtype=float))
+                intensity = np.tile(norm_row, (len(theta), 1))
+                colors = self.cm.jet(intensity); colors[:, :, 3] = np.power(intensity, 3) * 0.9 + 0.1
+                colors[-1, :, 3] = 0.0
+                cs.append(colors)
+            ax.plot_surface(np.vstack(xs), np.vstack(ys), np.vstack(zs), facecolors=np.vstack(cs), rstride=1, cstride=1, shade=False)
+            ax.set_box_aspect((1, 1, 3))
+        elif mode == "Revolution":
+            col_idx = max(0, min(axis_x, w-1)); start_c = max(0, col_idx-2); end_c = min(w, col_idx+3)
+            slice_data = np.mean(gray[:, start_c:end_c], axis=1)[::step_down]
+            d_min, d_max = slice_data.min(), slice_data.max()
+            norm_data = (slice_data - d_min) / (d_max - d_min) if d_max > d_min else slice_data/255.0
+            z = np.arange(len(slice_data)); theta = np.linspace(0, 2*np.pi, 60); Z, Theta = np.meshgrid(z, theta)
+            R = 10 + (np.tile(norm_data, (len(theta), 1)) * 15.0)
+            X = R * np.cos(Theta); Y = R * np.sin(Theta)
+            color_matrix = np.tile(norm_data, (len(theta), 1))
+            ax.plot_surface(X, Y, Z, facecolors=self.cm.inferno(color_matrix), shade=False); ax.set_box_aspect((1, 1, 3))
+        else:
+            start_col = max(0, min(axis_x, w-1)); roi = gray[:, start_col:]; down = roi[::step_down, ::step_down]
+            f_img = down.astype(np.float32); f_bg = cv2.GaussianBlur(f_img, (31, 31), 0); z_data = f_img - f_bg
+            dmin, dmax = z_data.min(), z_data.max()
+            norm_down = (z_data - dmin) / (dmax - dmin) if dmax > dmin else (z_data - dmin)
+            X, Y = np.meshgrid(np.arange(down.shape[1]), np.arange(down.shape[0]))
+            ax.plot_surface(X, Y, z_data, facecolors=self.cm.jet(norm_down), linewidth=0, antialiased=False); ax.set_zlim(-50, 50); ax.set_box_aspect((4, 3, 0.4))
+
+        ax.axis('off'); ax.view_init(elev=elev, azim=azim)
+        self.fig.canvas.draw(); buf = self.fig.canvas.buffer_rgba()
+        data = np.frombuffer(buf, dtype=np.uint8)
+        w_can, h_can = self.fig.canvas.get_width_height(); data = data.reshape((h_can, w_can, 4))
+        return cv2.cvtColor(data, cv2.COLOR_RGBA2BGR)
+
+def render_3d_frame(cv_img, step_down=4, elev=30, azim=-60, axis_x=0, mode="Topography", quality=True):
+    # quality=False uses the NumPy/OpenCV rasterizer (render3d), fast enough for live preview
+    if not quality: return render3d.render(cv_img, step_down=step_down, elev=elev, azim=azim, axis_x=axis_x, mode=mode)
+    return Renderer3D().render(cv_img, step_down=step_down, elev=elev, azim=azim, axis_x=axis_x, mode=mode)
+
+# One persistent renderer per pool worker process
+_worker_renderer = None
+
+def _init_render_worker():
+    global _worker_renderer
+    _worker_renderer = Renderer3D()
+
+def _render_worker(path, kwargs):
+    return _worker_renderer.render(cv2.imread(path), **kwargs)
+
+def iter_3d_frames(paths, workers=None, **kwargs):
+    """Render image files on a process pool, yielding results in input order."""
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as pool:
+        pending = deque()
+        try:
+            for path in paths:
+                pending.append(pool.submit(_render_worker, path, kwargs))
+                # Keep a small window in flight so memory stays bounded
+                if len(pending) >= 2 * workers: yield pending.popleft().result()
+            while pending: yield pending.popleft().result()
+        finally:
+            for f in pending: f.cancel()
+
+@perf.probe("generate_video")
+def generate_video(scan_dir, fps=10, render_3d=False, elev=30, azim=-60, axis_x=0, mode_3d="Topography", workers=None, progress=None, cancel=None, quality=True):
     images = sorted([img for img in os.listdir(scan_dir) if img.endswith(".png") and img.startswith("frame_")])
     if not images: return None
-    frame0 = cv2.imread(os.path.join(scan_dir, images[0]))
-    if render_3d:
-        temp = render_3d_frame(frame0, step_down=4, elev=elev, azim=azim, axis_x=axis_x, mode=mode_3d)
-        h, w, _ = temp.shape
-    else: h, w, _ = frame0.shape
+    paths = [os.path.join(scan_dir, img) for img in images]
+    if render_3d and not quality:
+        frames = (render3d.render(cv2.imread(p), step_down=4, elev=elev, azim=azim, axis_x=axis_x, mode=mode_3d) for p in paths)
+    elif render_3d:
+        frames = iter_3d_frames(paths, workers=workers, step_down=4, elev=elev, azim=azim, axis_x=axis_x, mode=mode_3d)
+    else:
+        frames = (cv2.imread(p) for p in paths)
     out_path = os.path.join(scan_dir, "output_3d.avi" if render_3d else "output_2d.avi")
-    video = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
-    count = 0; total = len(images)
+    video = None
+    total = len(images)
     print(f"Generating Video ({total} frames)...")
-    for image in images:
-        count += 1
-        if count % 10 == 0: print(f"Encoding {count}/{total}...")
-        frame = cv2.imread(os.path.join(scan_dir, image))
-        if render_3d: frame = render_3d_frame(frame, step_down=4, elev=elev, azim=azim, axis_x=axis_x, mode=mode_3d)
-        video.write(frame)
-    video.release()
+    try:
+        for count, frame in enumerate(frames, 1):
+            if video is None:
+                h, w, _ = frame.shape
+                video = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (w, h))
+            video.write(frame)
+            if progress: progress(count, total)
+            elif count % 10 == 0: print(f"Encoding {count}/{total}...")
+            if cancel is not None and cancel.is_set(): break
+    finally:
+        frames.close()
+        if video is not None: video.release()
     return out_path
 
 def save_image(img, folder, filename):
     if not os.path.exists(folder): os.makedirs(folder)
-    cv2.imwrite(os.path.join(folder, filename), img)
+    with perf.probe("imwrite"): ok = cv2.imwrite(os.path.join(folder, filename), img)
+    if not ok: raise IOError(f"Could not write {os.path.join(folder, filename)}")
+
+if __name__ == "__main__":
+    # python -m processor reprocess <scan_dir> ...
+    import reprocess
+    reprocess.main()
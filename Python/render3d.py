@@ -0,0 +1,162 @@
+# render3d.py
+# NumPy/OpenCV software renderer for the 3D views in processor.render_3d_frame.
+# Coarse grids (matplotlib's default 50 x 50 surface) are filled quad by quad
+# in painter's order; dense ones are splatted as sub-pixel samples, as many per
+# quad as its own projected edges need, into a depth-rank buffer. No matplotlib
+# figure is involved; processor.Renderer3D remains the reference "quality" path.
+import functools
+import cv2
+import numpy as np
+
+BG_COLOR = (255, 255, 255)
+# Grids with at most this many quads are filled as polygons, larger ones splatted
+POLY_MAX_QUADS = 4096
+
+@functools.lru_cache(maxsize=64)
+def view_matrix(elev, azim):
+    """Rows are screen right, screen up and toward-viewer, in matplotlib's elev/azim convention."""
+    e, a = np.radians(elev), np.radians(azim)
+    right = [-np.sin(a), np.cos(a), 0.0]
+    up = [-np.sin(e) * np.cos(a), -np.sin(e) * np.sin(a), np.cos(e)]
+    eye = [np.cos(e) * np.cos(a), np.cos(e) * np.sin(a), np.sin(e)]
+    return np.array([right, up, eye], np.float32)
+
+@functools.lru_cache(maxsize=64)
+def _fit(elev, azim, aspect, size):
+    """Screen scale/offset that fits the projected aspect box into the output image."""
+    ax, ay, az = aspect
+    corners = np.array([[x, y, z] for x in (-ax/2, ax/2) for y in (-ay/2, ay/2) for z in (-az/2, az/2)], np.float32)
+    s = corners @ view_matrix(elev, azim).T
+    lo, hi = s[:, :2].min(axis=0), s[:, :2].max(axis=0)
+    w, h = size
+    k = 0.9 * min(w / max(hi[0] - lo[0], 1e-6), h / max(hi[1] - lo[1], 1e-6))
+    return k, (lo + hi) / 2
+
+@functools.lru_cache(maxsize=256)
+def _samples(ks, kt):
+    """(s, t) of a ks x kt grid of sample points inside the unit quad."""
+    s, t = np.meshgrid((np.arange(ks, dtype=np.float32) + 0.5) / ks, (np.arange(kt, dtype=np.float32) + 0.5) / kt)
+    return s.reshape(-1, 1, 1), t.reshape(-1, 1, 1)
+
+def _stride(n, count=50):
+    """Grid lines plot_surface keeps by default (rcount/ccount = 50)."""
+    step = max(int(np.ceil(n / count)), 1)
+    return np.r_[np.arange(0, n - 1, step), n - 1]
+
+def _colormap(norm, cmap):
+    return cv2.applyColorMap(np.clip(norm * 255, 0, 255).astype(np.uint8), cmap)
+
+def rasterize(X, Y, Z, colors, aspect, elev=30, azim=-60, size=(640, 480), alpha=None, limits=None):
+    """Draw a grid surface. colors is per-vertex BGR; each quad takes its top-left vertex colour.
+
+    aspect is the box aspect like Axes3D.set_box_aspect, and limits optionally
+    fixes the data range per axis ((lo, hi) or None) as set_zlim does.
+    """
+    P = np.stack([X, Y, Z], axis=-1).astype(np.float32)
+    for i in range(3):
+        lo, hi = limits[i] if limits and limits[i] else (P[..., i].min(), P[..., i].max())
+        P[..., i] = ((P[..., i] - lo) / max(hi - lo, 1e-6) - 0.5) * aspect[i]
+    S = P @ view_matrix(elev, azim).T
+    k_fit, centre = _fit(elev, azim, tuple(aspect), tuple(size))
+    w, h = size
+    S[..., 0] = (S[..., 0] - centre[0]) * k_fit + w / 2
+    S[..., 1] = h / 2 - (S[..., 1] - centre[1]) * k_fit
+
+    # Quad q of the (H - 1) x (W - 1) grid has its top-left corner at vertex q + q // (W - 1)
+    H, W = X.shape
+    col = colors[:-1, :-1].reshape(-1, 3)
+    quad = np.arange((H - 1) * (W - 1))
+    if alpha is not None:
+        # Translucency is approximated: faint quads are dropped, the rest are
+        # blended with the background at their own alpha.
+        a = alpha[:-1, :-1].reshape(-1)
+        quad = np.flatnonzero(a > 0.35); a = a[quad, None]
+        col = (col[quad] * a + np.float32(BG_COLOR) * (1 - a)).astype(np.uint8)
+    v = quad + quad // (W - 1)
+    S = S.reshape(-1, 3)
+    (x00, y00, z00), (x01, y01, z01), (x10, y10, z10), (x11, y11, z11) = (S[i].T for i in (v, v + 1, v + W, v + W + 1))
+
+    n = len(quad)
+    far_to_near = np.argsort(z00 + z01 + z10 + z11)
+    if n <= POLY_MAX_QUADS:
+        # Exact fill, painter's order; corners in 1/16 px
+        quads = np.round(np.stack([x00, y00, x01, y01, x11, y11, x10, y10], axis=1)[far_to_near] * 16).astype(np.int32).reshape(-1, 4, 2)
+        img = np.empty((h, w, 3), np.uint8); img[:] = BG_COLOR
+        for corners, c in zip(quads, col[far_to_near].tolist()):
+            cv2.fillConvexPoly(img, corners, c, lineType=cv2.LINE_8, shift=4)
+        return img
+
+    # Depth rank per quad (0 = farthest); each pixel keeps the highest rank splatted on it
+    rank = np.empty(n, np.int32); rank[far_to_near] = np.arange(n, dtype=np.int32)
+
+    # Samples along s (columns) and t (rows) per quad: enough for its own longest
+    # edge in that direction to leave no holes. Quads with the same grid are splatted together.
+    span = lambda xa, ya, xb, yb: np.maximum(np.abs(xa - xb), np.abs(ya - yb))
+    ks = np.clip(np.ceil(np.maximum(span(x01, y01, x00, y00), span(x11, y11, x10, y10))), 1, 16).astype(np.int32)
+    kt = np.clip(np.ceil(np.maximum(span(x10, y10, x00, y00), span(x11, y11, x01, y01))), 1, 16).astype(np.int32)
+    grid = (ks * 17 + kt).astype(np.int16)
+    by_grid = np.argsort(grid, kind="stable"); bounds = np.flatnonzero(np.diff(grid[by_grid])) + 1
+
+    # Bilinear corners as p = p00 + s * ds + t * dt + s * t * dst
+    dx_s, dy_s = x01 - x00, y01 - y00; dx_t, dy_t = x10 - x00, y10 - y00
+    dx_st, dy_st = x11 - x01 - dx_t, y11 - y01 - dy_t
+    zbuf = np.full(h * w, -1, np.int32)
+    for q in np.split(by_grid, bounds):
+        if not len(q): continue
+        s, t = (u[:, 0] for u in _samples(int(ks[q[0]]), int(kt[q[0]])))
+        st = s * t
+        px = (x00[q] + s * dx_s[q] + t * dx_t[q] + st * dx_st[q]).astype(np.int32).ravel()
+        py = (y00[q] + s * dy_s[q] + t * dy_t[q] + st * dy_st[q]).astype(np.int32).ravel()
+        ok = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+        np.maximum.at(zbuf, (py * w + px)[ok], np.broadcast_to(rank[q], (len(s), len(q))).ravel()[ok])
+
+    # Background is rank -1, i.e. palette entry 0
+    palette = np.empty((n + 1, 3), np.uint8); palette[0] = BG_COLOR
+    palette[1:][rank] = col
+    return np.take(palette, zbuf + 1, axis=0).reshape(h, w, 3)
+
+def render(cv_img, step_down=4, elev=30, azim=-60, axis_x=0, mode="Topography", size=(640, 480)):
+    if len(cv_img.shape) == 3: gray = cv2.cvtColor(cv_img, cv2.COLOR_BGR2GRAY)
+    else: gray = cv_img
+    h, w = gray.shape
+    col_idx = max(0, min(axis_x, w-1))
+
+    if mode == "Stacked Slices":
+        roi = gray[:, col_idx:]; rh = roi.shape[0]
+        slice_step = max(1, rh // 30); theta = np.linspace(0, 2*np.pi, 50, dtype=np.float32)
+        rows = roi[::slice_step, ::step_down].astype(np.float32)
+        dmin = rows.min(axis=1, keepdims=True); dmax = rows.max(axis=1, keepdims=True)
+        norm = np.where(dmax - dmin > 10, (rows - dmin) / np.maximum(dmax - dmin, 1e-6), rows / 255.0)
+        r = np.arange(rows.shape[1], dtype=np.float32)
+        # One ring per slice, stacked along the grid rows; quads bridging two slices are fully transparent
+        n = len(theta)
+        X = np.tile(np.outer(np.cos(theta), r), (len(rows), 1))
+        Y = np.tile(np.outer(np.sin(theta), r), (len(rows), 1))
+        Z = np.repeat(rh - np.arange(0, rh, slice_step, dtype=np.float32), n)[:, None] * np.ones_like(r)
+        intensity = np.repeat(norm, n, axis=0)
+        alpha = np.power(intensity, 3) * 0.9 + 0.1
+        alpha[n-1::n] = 0.0
+        return rasterize(X, Y, Z, _colormap(intensity, cv2.COLORMAP_JET), (1, 1, 3), elev, azim, size, alpha=alpha)
+
+    if mode == "Revolution":
+        start_c = max(0, col_idx-2); end_c = min(w, col_idx+3)
+        slice_data = np.mean(gray[:, start_c:end_c], axis=1)[::step_down]
+        d_min, d_max = slice_data.min(), slice_data.max()
+        norm_data = (slice_data - d_min) / (d_max - d_min) if d_max > d_min else slice_data/255.0
+        theta = np.linspace(0, 2*np.pi, 60, dtype=np.float32)
+        Z, Theta = np.meshgrid(np.arange(len(slice_data), dtype=np.float32), theta)
+        N = np.tile(norm_data.astype(np.float32), (len(theta), 1))
+        # Same grid as plot_surface's default in the quality path
+        ri, ci = _stride(N.shape[0]), _stride(N.shape[1]); Z, Theta, N = (a[ri][:, ci] for a in (Z, Theta, N))
+        R = 10 + N * 15.0
+        return rasterize(R * np.cos(Theta), R * np.sin(Theta), Z, _colormap(N, cv2.COLORMAP_INFERNO), (1, 1, 3), elev, azim, size)
+
+    down = gray[:, col_idx:][::step_down, ::step_down]
+    f_img = down.astype(np.float32); z_data = f_img - cv2.GaussianBlur(f_img, (31, 31), 0)
+    dmin, dmax = z_data.min(), z_data.max()
+    norm_down = (z_data - dmin) / (dmax - dmin) if dmax > dmin else (z_data - dmin)
+    X, Y = np.meshgrid(np.arange(down.shape[1], dtype=np.float32), np.arange(down.shape[0], dtype=np.float32))
+    ri, ci = _stride(X.shape[0]), _stride(X.shape[1])
+    X, Y, z_data, norm_down = (a[ri][:, ci] for a in (X, Y, z_data, norm_down))
+    return rasterize(X, Y, np.clip(z_data, -50, 50), _colormap(norm_down, cv2.COLORMAP_JET), (4, 3, 0.4), elev, azim, size,
+                     limits=(None, None, (-50, 50)))
@@ -0,0 +1,109 @@
+# reprocess.py
+# Headless reprocessing of saved scans with new display parameters:
+#   python -m processor reprocess <scan_dir> --mode "Heatmap (Inferno)" --gain 40 --ghost 3,0,0.2
+#   python -m processor reprocess <scan_dir> --abel 0.5 --abel 0.52   # Abel inverted about x = 0.5 W, 0.52 W
+# --mode, --gain, --ghost and --abel may be repeated; every combination is rendered in
+# one pass so each raw frame is decoded once. Needs no Tk, pigpio or camera.
+import argparse
+import itertools
+import os
+import re
+from multiprocessing import Pool
+import cv2
+
+import config
+import processor
+import scanstore
+
+def find_sources(scan_dir):
+    """(delay, source) pairs sorted by delay, from the scan store or raw_sig_/raw_bg_ PNGs."""
+    if scanstore.is_scan_store(scan_dir):
+        reader = scanstore.ScanReader(scan_dir)
+        return [(reader.delays[i], i) for i in reader.order()]
+    sources = []
+    for f in sorted(os.listdir(scan_dir)):
+        m = re.match(r"raw_sig_(\d+)\.png$", f)
+        if m and os.path.exists(os.path.join(scan_dir, f"raw_bg_{m.group(1)}.png")):
+            sources.append((int(m.group(1)), (f, f"raw_bg_{m.group(1)}.png")))
+    return sources
+
+def param_sets(modes, gains, ghosts, abels=(None,)):
+    return [{"mode": m, "gain": g, "ghost": gh, "abel": a} for m, g, gh, a in itertools.product(modes, gains, ghosts, abels)]
+
+def set_dirname(ps):
+    mode = re.sub(r"[^A-Za-z0-9]+", "-", ps["mode"]).strip("-")
+    dx, dy, amp = ps["ghost"]
+    abel = f"_abel{ps['abel']:g}" if ps.get("abel") is not None else ""
+    return f"{mode}_g{ps['gain']:g}_gh{dx}_{dy}_{amp:g}{abel}"
+
+def parse_ghost(text):
+    dx, dy, amp = text.split(",")
+    return (int(dx), int(dy), float(amp))
+
+# Per worker process state
+_worker = {}
+
+def _init_worker(scan_dir, sets, out_dirs):
+    _worker.update(scan_dir=scan_dir, sets=sets, out_dirs=out_dirs, proc=processor.FrameProcessor(),
+                   reader=scanstore.ScanReader(scan_dir) if scanstore.is_scan_store(scan_dir) else None)
+
+def _load(source):
+    if _worker["reader"] is not None:
+        sig, bg, _ = _worker["reader"][source]
+        return scanstore.to_u8(sig), scanstore.to_u8(bg)
+    sig_f, bg_f = source
+    d = _worker["scan_dir"]
+    return cv2.imread(os.path.join(d, sig_f), cv2.IMREAD_GRAYSCALE), cv2.imread(os.path.join(d, bg_f), cv2.IMREAD_GRAYSCALE)
+
+def _process(task):
+    delay, source = task
+    s_gray, b_gray = _load(source)
+    for ps, out_dir in zip(_worker["sets"], _worker["out_dirs"]):
+        abel_axis = int(ps["abel"] * s_gray.shape[1]) if ps.get("abel") is not None else None
+        final = _worker["proc"].process(s_gray, b_gray, ps["gain"], ps["mode"], ps["ghost"], abel_axis, ps.get("abel_ds", config.ABEL_DS))
+        processor.save_image(final, out_dir, f"frame_{delay:05d}.png")
+    return delay
+
+def reprocess(scan_dir, sets, out_root=None, workers=None, fps=15, video=True):
+    sources = find_sources(scan_dir)
+    if not sources: raise RuntimeError(f"No raw frames found in {scan_dir}")
+    out_root = out_root or os.path.join(scan_dir, "reprocess")
+    out_dirs = [os.path.join(out_root, set_dirname(ps)) for ps in sets]
+    for d in out_dirs: os.makedirs(d, exist_ok=True)
+
+    print(f"Reprocessing {len(sources)} frames x {len(sets)} parameter sets...")
+    with Pool(workers or os.cpu_count(), initializer=_init_worker, initargs=(scan_dir, sets, out_dirs)) as pool:
+        for n, _ in enumerate(pool.imap_unordered(_process, sources, chunksize=4), 1):
+            if n % 10 == 0: print(f"Processed {n}/{len(sources)}...")
+
+    if video:
+        for d in out_dirs: print(f"Saved {processor.generate_video(d, fps=fps)}")
+    return out_dirs
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(prog="python -m processor")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    rp = sub.add_parser("reprocess", help="re-render a saved scan with new processing parameters")
+    rp.add_argument("scan_dir")
+    rp.add_argument("--mode", action="append", help="display mode (repeatable)")
+    rp.add_argument("--gain", action="append", type=float, help="digital gain (repeatable)")
+    rp.add_argument("--ghost", action="append", type=parse_ghost, help="ghost removal dx,dy,amp (repeatable)")
+    rp.add_argument("--abel", action="append", type=float, help="Abel inversion about x = AXIS * width (repeatable)")
+    rp.add_argument("--abel-ds", type=int, default=config.ABEL_DS, help="Abel grid downsampling (default %(default)s)")
+    rp.add_argument("--out", help="output folder (default <scan_dir>/reprocess)")
+    rp.add_argument("--workers", type=int, default=None)
+    rp.add_argument("--fps", type=int, default=None, help="video FPS (default: the scan's Vid FPS)")
+    rp.add_argument("--no-video", action="store_true")
+    args = ap.parse_args(argv)
+
+    # Unspecified parameters default to the ones the scan was taken with
+    p = scanstore.ScanReader(args.scan_dir).params if scanstore.is_scan_store(args.scan_dir) else {}
+    sets = param_sets(args.mode or [p.get("v_mode", "Enhanced")],
+                      args.gain or [p.get("v_gain_dig", 25.0)],
+                      args.ghost or [(p.get("v_gx", 0), p.get("v_gy", 0), p.get("v_gamp", 0.0))],
+                      args.abel or [p.get("v_abel_axis", 0.5) if p.get("v_abel") else None])
+    for ps in sets: ps["abel_ds"] = args.abel_ds
+    reprocess(args.scan_dir, sets, args.out, args.workers, args.fps or p.get("v_video_fps", 15), not args.no_video)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+# scan.py
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+import numpy as np
+
+import camera
+import config
+import hardware
+import lockin
+import perf
+import processor
+import scanstore
+import videostream
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.busy = 0.0
+        self.t0 = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.busy += seconds
+
+    def rate(self):
+        return self.count / max(1e-6, time.perf_counter() - self.t0)
+
+    def __str__(self):
+        return f"{self.name} {self.rate():.2f}/s"
+
+class ScanPipeline:
+    """Bounded hand-off from the capture stage to a pool of processing workers.
+
+    submit() blocks once `depth` delays are waiting, so capture never runs more
+    than `depth` steps ahead of processing (backpressure). Each worker gets its
+    own context dict for per-thread state such as a FrameProcessor. Items whose
+    handler raised are counted in `failed`, with the first exception in `error`.
+    """
+    def __init__(self, handler, workers=config.SCAN_WORKERS, depth=config.SCAN_QUEUE_DEPTH):
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=depth)
+        self.capture = StageStats("cap")
+        self.process = StageStats("proc")
+        self.failed = 0
+        self.error = None
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(max(1, workers))]
+        for t in self.threads: t.start()
+
+    def submit(self, item):
+        self.queue.put(item)
+
+    def _worker(self):
+        ctx = {}
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            t = time.perf_counter()
+            try: self.handler(item, ctx)
+            except Exception as e:
+                print(f"Pipeline Error: {e}")
+                with self.lock:
+                    self.failed += 1; self.error = self.error or e
+            self.process.add(time.perf_counter() - t)
+
+    def close(self):
+        """Waits for the workers; returns the number of items that failed."""
+        for _ in self.threads: self.queue.put(None)
+        for t in self.threads: t.join()
+        if self.failed: print(f"Pipeline: {self.failed} items failed, first: {self.error}")
+        return self.failed
+
+    def status(self):
+        return f"{self.capture} | {self.process} | q {self.queue.qsize()}"
+
+# Scan parameters when run without the UI (the UI's defaults)
+DEFAULT_PARAMS = dict(v_trig_fps=config.DEFAULT_FPS, v_freq=config.DEFAULT_FREQ, v_cycles=config.DEFAULT_CYCLES,
+                      v_delay=config.DEFAULT_DELAY, v_led=config.DEFAULT_LED_US, v_exp=config.DEFAULT_CAM_EXP,
+                      v_gain_ana=config.DEFAULT_ANA_GAIN, v_gain_dig=config.DEFAULT_DIG_GAIN, v_mode="Enhanced",
+                      v_gx=0, v_gy=0, v_gamp=0.0, v_start=config.DEFAULT_START, v_end=config.DEFAULT_END,
+                      v_step=config.DEFAULT_STEP, v_stack=config.DEFAULT_STACK, v_video_fps=15, v_save_raw=True, v_ctx=True)
+
+class ScanEngine:
+    """Delay sweep: captures on the calling thread, processes and saves on a pipeline.
+
+    params uses the same keys as the settings files (v_freq, v_stack, ...).
+    camera is the app's CameraManager; without one the engine opens its own.
+    scan_dir defaults to scans/<timestamp>.
+    """
+    def __init__(self, hw, params, status=print, stop_event=None, camera=None, scan_dir=None):
+        self.hw = hw
+        self.camera = camera
+        self.scan_dir = scan_dir
+        self.p = params
+        self.status = status
+        self.stop_event = stop_event or threading.Event()
+        self.store = None
+        self.store_lock = threading.Lock()
+        self.stack_log = []
+        self.video = None
+        self.lockin = None
+        # Delays lost in processing, and the first error; a scan is complete when failed == 0
+        self.failed = 0
+        self.error = None
+
+    def run(self, single_shot):
+        if self.camera is not None: return self._run(single_shot)
+        self.camera = camera.CameraManager()
+        try: return self._run(single_shot)
+        finally: self.camera.close(); self.camera = None
+
+    def _run(self, single_shot):
+        p = self.p
+        ts = datetime.now().strftime('%Y%m%d_%H%M%S')
+        scan_dir = self.scan_dir or os.path.join("scans", ts)
+        if not os.path.exists(scan_dir): os.makedirs(scan_dir)
+        perf.reset()
+
+        fps = p["v_trig_fps"]
+        # Context and scan frames cover only the ROI from here on
+        self.camera.set_roi(p.get("v_roi"))
+
+        if p["v_ctx"]:
+            self.status("Taking Context (LED Off)...")
+            self.hw.update_wave(0, p["v_exp"], p["v_led"], 0, 0, fps, False, False, False)
+            max_safe_us = int(1000000/fps) - 10000
+            cam = self.camera.use("context", {"ExposureTime": max_safe_us, "AnalogueGain": p["v_gain_ana"], "AeEnable": False, "AwbEnable": False})
+            frames = [camera.capture(cam, self.camera.size, crop=self.camera.crop) for _ in range(5)]
+            avg = np.mean(np.array(frames), axis=0)
+            processor.save_image(avg.astype(np.uint8), scan_dir, "ref_context.png")
+
+        delays = [p["v_delay"]] if single_shot else range(p["v_start"], p["v_end"]+1, p["v_step"])
+
+        self.status("Init Scan...")
+        self.hw.update_wave(delays[0], p["v_exp"], p["v_led"], p["v_freq"], p["v_cycles"], fps, True, True, interleaved=True, sync=True)
+        cam = self.camera.use("scan", {
+            "ExposureTime": max(p["v_exp"]+100, 200),
+            "AnalogueGain": p["v_gain_ana"],
+            "AeEnable": False, "AwbEnable": False
+        })
+
+        sig_acc = processor.StackAccumulator(); bg_acc = processor.StackAccumulator()
+        # Frames go to the encoder as the workers finish them, in delay order
+        self.video = None if single_shot else videostream.VideoStream(os.path.join(scan_dir, "output_2d.avi"), p["v_video_fps"], p.get("v_video_ffv1", config.VIDEO_FFV1))
+        self.lockin = lockin.LockIn(p["v_freq"]) if p.get("v_lockin") and not single_shot else None
+        if self.lockin: self.lockin.check_sampling(delays)
+        pipe = ScanPipeline(lambda item, ctx: self.process_delay(scan_dir, item, ctx))
+
+        self.stack_log = []
+        try:
+            if p.get("v_sequencer") and not single_shot:
+                if p.get("v_adaptive"): print("Sequencer: the chain is fixed in advance, adaptive stacking is off")
+                self.capture_sequenced(cam, delays, sig_acc, bg_acc, pipe)
+            else:
+                self.capture_stepped(cam, delays, sig_acc, bg_acc, pipe)
+        finally:
+            self.hw.stop()
+            self.status(f"Finishing writes... ({pipe.status()})")
+            self.failed = pipe.close(); self.error = pipe.error
+            if self.store: self.store.close(); self.store = None
+            # Every delay is captured and processed: the video is complete
+            vid = self.video.close() if self.video else None; self.video = None
+            if self.lockin:
+                try: print(f"Lock-in: {len(self.lockin.save(scan_dir))} maps from {self.lockin.n} delays")
+                except Exception as e: print(f"Lock-in Error: {e}")
+                self.lockin = None
+        print(f"Scan throughput: {pipe.status()}")
+
+        # --- VIDEO ---
+        if self.failed:
+            self.status(f"Scan incomplete: {self.failed} delays failed ({self.error})")
+        elif not single_shot:
+            self.status(f"Saved {os.path.basename(vid)}" if vid else "Video failed: No frames written")
+        else:
+            self.status("Snapshot Saved")
+        failures = {"failed": self.failed, "error": str(self.error) if self.error else None}
+        try:
+            perf.write_json(scan_dir, {"throughput": pipe.status(), "single_shot": single_shot, "stack": self.stack_log, **failures})
+            scanstore.update_meta(scan_dir, stack=self.stack_log, **failures)
+        except Exception as e: print(f"Perf Error: {e}")
+        return scan_dir
+
+    def capture_stepped(self, cam, delays, sig_acc, bg_acc, pipe):
+        p = self.p; fps = p["v_trig_fps"]; stack = p["v_stack"]
+        # Adaptive: v_stack is the most pairs per delay, v_stack_min the fewest
+        adaptive = processor.AdaptiveStack(p.get("v_noise_target", config.DEFAULT_NOISE_TARGET), p.get("v_stack_min", config.DEFAULT_STACK_MIN),
+                                           stack, self.noise_roi()) if p.get("v_adaptive") else None
+        wave_args = lambda d: (d, p["v_exp"], p["v_led"], p["v_freq"], p["v_cycles"], fps, True, True, True)
+        for i, d in enumerate(delays):
+            self.status(f"Capturing {d}us... ({pipe.status()})")
+            t = time.perf_counter()
+            self.hw.prefetch([wave_args(x) for x in delays[i+1:i+1+config.WAVE_PREFETCH]])
+            self.hw.update_wave(*wave_args(d), sync=True)
+            # The switch lands on a period boundary. Frames still queued from the
+            # previous wave are older than it and get rejected by timestamp
+            self.hw.wait_for_wave()
+            timing = hardware.HardwareManager.wave_timing(hardware.HardwareManager.wave_key(*wave_args(d)))
+            pairer = camera.FramePairer(timing, camera.sensor_clock_ns() - config.PAIR_STALE_US * 1000)
+
+            taken = 0; pending = None
+            if adaptive: adaptive.reset()
+            for slot, frame in camera.placed_frames(cam, self.camera.size, lambda ts: (pairer, 0), self.camera.crop):
+                taken += 1
+                # Accumulates straight from the camera buffer in luma mode
+                if slot is not None:
+                    acc = bg_acc if slot & 1 else sig_acc
+                    if acc.n < stack: acc.add(frame)
+                    if adaptive:
+                        # Noise is measured on pairs from the same wave period
+                        if not slot & 1: pending = (slot, adaptive.crop(frame).copy())
+                        elif pending and pending[0] == slot - 1: adaptive.add(pending[1], adaptive.crop(frame)); pending = None
+                if adaptive.done() if adaptive else (sig_acc.n >= stack and bg_acc.n >= stack): break
+                if taken >= 4 * stack + 10 or self.stop_event.is_set(): break
+            self.count_pairing(pairer)
+            pipe.capture.add(time.perf_counter() - t)
+            if adaptive and adaptive.n < adaptive.min_n or not adaptive and (sig_acc.n < stack or bg_acc.n < stack):
+                print(f"Delay {d}us: only {sig_acc.n}/{bg_acc.n} of {stack} frames placed")
+            self.log_stack(d, sig_acc.n, bg_acc.n, adaptive)
+            # Blocks while the workers are `depth` delays behind
+            if sig_acc.n and bg_acc.n: pipe.submit((i, d, sig_acc.detach(), bg_acc.detach()))
+            else: sig_acc.reset(); bg_acc.reset(); self.skip_delay(i)
+
+            if self.stop_event.is_set(): break
+
+    def capture_sequenced(self, cam, delays, sig_acc, bg_acc, pipe):
+        """Whole sweep runs as one chained waveform. Frames are placed on the known
+        schedule by timestamp, so a dropped frame costs one sample instead of
+        shifting every later frame onto the wrong delay or phase."""
+        p = self.p; stack = p["v_stack"]
+        seq = hardware.Sequencer(self.hw, delays, p["v_stack"], p["v_exp"], p["v_led"], p["v_freq"], p["v_cycles"], p["v_trig_fps"])
+        plan = seq.dry_run()
+        print(f"Sequencer plan: {plan}")
+        timings = {hardware.HardwareManager.wave_timing(k) for k in seq.keys}
+        if len(timings) > 1:
+            # Pass lengths change within the sweep: period positions can't be predicted
+            print(f"Sequencer: wave timing varies over the sweep {sorted(timings)}, placing frames by arrival order")
+            return self.capture_sequenced_ordered(cam, seq, sig_acc, bg_acc, pipe)
+        timing = timings.pop(); n_slots = 2 * stack * len(seq.delays)
+        # Triggers move with the delay; period k of a chain starting at period `base`
+        delay_at = lambda period: seq.delays[min(period // seq.stack, len(seq.delays) - 1)]
+        shift = lambda base: lambda k: (delay_at(base + k) - delay_at(base)) * 1000
+        # Until the first chain is sent every frame is stale
+        segment = {"n": 0, "pairer": camera.FramePairer(timing, 1 << 62), "base": 0}
+
+        def pairer_at(ts):
+            segment["ts"] = ts
+            # A frame after the next chain was sent belongs to that chain
+            while segment["n"] < len(seq.starts) and seq.starts[segment["n"]][0] <= ts:
+                start, base = seq.starts[segment["n"]]; segment["n"] += 1
+                self.count_pairing(segment["pairer"])
+                segment["pairer"] = camera.FramePairer(timing, start, shift=shift(base)); segment["base"] = 2 * base
+            return segment["pairer"], segment["base"]
+
+        seq.start()
+        try:
+            i = 0; t = time.perf_counter(); last = -1; nxt = 0
+            for slot, frame in camera.placed_frames(cam, self.camera.size, pairer_at, self.camera.crop):
+                if slot is None:
+                    if self.stop_event.is_set() or self.past_schedule(seq, segment["ts"], n_slots // 2, timing): break
+                    continue
+                k = slot // (2 * stack)
+                if k != i and (sig_acc.n or bg_acc.n):
+                    self.submit_sequenced(pipe, seq, i, sig_acc, bg_acc); t = time.perf_counter(); nxt = i + 1
+                # Delays with no placed frame at all are skipped, or the video would hold every later frame
+                for j in range(nxt, k): self.submit_sequenced(pipe, seq, j, sig_acc, bg_acc)
+                nxt = max(nxt, k)
+                i = k; last = slot
+                (bg_acc if slot & 1 else sig_acc).add(frame)
+                if slot >= n_slots - 1 or self.stop_event.is_set(): break
+                if slot % (2 * stack) == 2 * stack - 1:
+                    pipe.capture.add(time.perf_counter() - t)
+                    self.status(f"Sequencer {i + 1}/{plan['delays']} ({pipe.status()})")
+            if sig_acc.n or bg_acc.n: self.submit_sequenced(pipe, seq, i, sig_acc, bg_acc); nxt = i + 1
+            if not self.stop_event.is_set():
+                for j in range(nxt, len(seq.delays)): self.submit_sequenced(pipe, seq, j, sig_acc, bg_acc)
+            self.count_pairing(segment["pairer"])
+            if last < n_slots - 1: print(f"Sequencer: stopped at frame {last + 1}/{n_slots}")
+        finally:
+            seq.stop()
+
+    def past_schedule(self, seq, ts, periods, timing):
+        """True once ts is a full wave period after the last chained period ends."""
+        if not seq.done.is_set() or not seq.starts: return False
+        start, base = seq.starts[-1]
+        return ts > start + (periods - base + 1) * sum(timing) * 1000
+
+    def submit_sequenced(self, pipe, seq, i, sig_acc, bg_acc):
+        """Hands delay i to the pipeline, or skips it when it has no complete pair (also with empty accumulators)."""
+        d = seq.delays[i]
+        if sig_acc.n < seq.stack or bg_acc.n < seq.stack: print(f"Delay {d}us: only {sig_acc.n}/{bg_acc.n} of {seq.stack} frames placed")
+        self.log_stack(d, sig_acc.n, bg_acc.n)
+        if not sig_acc.n or not bg_acc.n:
+            sig_acc.reset(); bg_acc.reset(); self.skip_delay(i); return
+        pipe.submit((i, d, sig_acc.detach(), bg_acc.detach()))
+
+    def capture_sequenced_ordered(self, cam, seq, sig_acc, bg_acc, pipe):
+        """Fallback: frames tagged from the schedule in arrival order."""
+        seq.start()
+        try:
+            i = 0; t = time.perf_counter()
+            for d, phase, rep in seq.schedule():
+                with perf.probe("capture"): camera.capture(cam, self.camera.size, (sig_acc if phase == 'sig' else bg_acc).add, self.camera.crop)
+                if phase == 'bg' and rep == seq.stack - 1:
+                    pipe.capture.add(time.perf_counter() - t); t = time.perf_counter()
+                    pipe.submit((i, d, sig_acc.detach(), bg_acc.detach()))
+                    i += 1
+                    self.status(f"Sequencer {i}/{len(seq.delays)} ({pipe.status()})")
+                    if self.stop_event.is_set(): break
+        finally:
+            seq.stop()
+
+    def noise_roi(self):
+        """Pixel rect for adaptive stacking in the frames being captured: the
+        noise ROI (v_noise_roi, fractions of the full frame) where it overlaps
+        the capture ROI; else the whole capture ROI if one is set; else None,
+        which AdaptiveStack takes as the central half of the frame."""
+        p = self.p; crop = self.camera.crop
+        w, h = crop[2:] if crop else self.camera.size
+        if p.get("v_noise_roi"):
+            rect = camera.roi_within(camera.SCAN_SIZE, p["v_noise_roi"], p.get("v_roi"))
+            if rect: return rect
+            print("Noise ROI is outside the capture ROI, using the whole frame")
+            return 0, 0, w, h
+        return (0, 0, w, h) if p.get("v_roi") else None
+
+    def skip_delay(self, i):
+        if self.video: self.video.skip(i)
+
+    def log_stack(self, d, n_sig, n_bg, adaptive=None):
+        """Frames used per delay, for the scan metadata."""
+        entry = {"delay": int(d), "signal": n_sig, "background": n_bg}
+        if adaptive:
+            noise = adaptive.noise()
+            entry.update(pairs=adaptive.n, noise=round(noise, 4) if np.isfinite(noise) else None)
+        self.stack_log.append(entry)
+
+    def count_pairing(self, pairer):
+        perf.count("pair.rejected", pairer.rejected); perf.count("pair.dropped", pairer.dropped)
+
+    def process_delay(self, scan_dir, item, ctx):
+        p = self.p
+        i, d, sig, bg = item
+        if "proc" not in ctx: ctx["proc"] = processor.FrameProcessor()
+        try:
+            s_gray = sig.mean_u8()
+            b_gray = bg.mean_u8()
+
+            if p["v_save_raw"]:
+                with self.store_lock:
+                    if self.store is None: self.store = scanstore.ScanWriter(scan_dir, sig.shape, p)
+                self.store.append(d, sig.mean, bg.mean, processor.noise_variance(sig, bg), n=sig.n)
+
+            if self.lockin:
+                # Full-precision stacked means, same flicker high-pass as the render
+                self.lockin.add(d, ctx["proc"].highpass(sig.mean, bg.mean))
+
+            ghost = (p["v_gx"], p["v_gy"], p["v_gamp"])
+            abel_axis = int(p["v_abel_axis"] * s_gray.shape[1]) if p.get("v_abel") else None
+            final = ctx["proc"].process(s_gray, b_gray, p["v_gain_dig"], p["v_mode"], ghost, abel_axis)
+            processor.save_image(final, scan_dir, f"frame_{d:05d}.png")
+        except Exception:
+            # The video must still move past this index, or it holds every later frame
+            self.skip_delay(i); raise
+        if self.video: self.video.put(i, final)
+        perf.tick("scan.delay")
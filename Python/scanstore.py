@@ -0,0 +1,135 @@
+# scanstore.py
+# Scan container: one append-only float32 file with a (signal, background,
+# variance) record per delay, an index log, and a JSON sidecar with the scan
+# parameters. Records are written before their index line, so after a crash
+# every indexed record is complete and a partial scan stays readable.
+import json
+import os
+import threading
+import numpy as np
+
+DATA_FILE = "stack.f32"
+INDEX_FILE = "index.log"
+META_FILE = "scan.json"
+PLANES = ("signal", "background", "variance")
+
+def _read_index(scan_dir):
+    path = os.path.join(scan_dir, INDEX_FILE)
+    if not os.path.exists(path): return []
+    with open(path) as f: text = f.read()
+    # A line without its newline was cut short by a crash
+    lines = text.split("\n")[:-1]
+    return [tuple(int(v) for v in line.split()) for line in lines if line]
+
+class ScanWriter:
+    """Appends one record per delay. Safe to call from several worker threads."""
+    def __init__(self, scan_dir, shape, params=None):
+        if not os.path.exists(scan_dir): os.makedirs(scan_dir)
+        self.scan_dir = scan_dir
+        self.shape = tuple(shape)
+        h, w = self.shape
+        self.record_bytes = len(PLANES) * h * w * 4
+        self.lock = threading.Lock()
+
+        meta_path = os.path.join(scan_dir, META_FILE)
+        if not os.path.exists(meta_path):
+            meta = {"version": 1, "shape": [h, w], "dtype": "float32", "planes": list(PLANES), "params": params or {}}
+            with open(meta_path + ".tmp", "w") as f: json.dump(meta, f, indent=1)
+            os.replace(meta_path + ".tmp", meta_path)
+
+        # Resume: drop a half-written record or index line left by a crash
+        index = _read_index(scan_dir)
+        data_path = os.path.join(scan_dir, DATA_FILE)
+        size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        self.count = min(len(index), size // self.record_bytes)
+        self.data = open(data_path, "ab")
+        self.data.truncate(self.count * self.record_bytes)
+        # The trimmed index replaces the old one in one step, so a crash here keeps either
+        index_path = os.path.join(scan_dir, INDEX_FILE)
+        with open(index_path + ".tmp", "w") as f:
+            f.writelines(" ".join(str(v) for v in e) + "\n" for e in index[:self.count])
+            f.flush(); os.fsync(f.fileno())
+        os.replace(index_path + ".tmp", index_path)
+        self.index = open(index_path, "a")
+
+    def append(self, delay, signal, background, variance, n=0):
+        with self.lock:
+            for plane in (signal, background, variance):
+                self.data.write(np.ascontiguousarray(plane, dtype=np.float32).data)
+            self.data.flush(); os.fsync(self.data.fileno())
+            self.index.write(f"{int(delay)} {int(n)}\n")
+            self.index.flush(); os.fsync(self.index.fileno())
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.data.close(); self.index.close()
+
+def update_meta(scan_dir, **fields):
+    """Adds fields to the scan.json of an existing store (no-op without one)."""
+    path = os.path.join(scan_dir, META_FILE)
+    if not os.path.exists(path): return False
+    with open(path) as f: meta = json.load(f)
+    meta.update(fields)
+    with open(path + ".tmp", "w") as f: json.dump(meta, f, indent=1)
+    os.replace(path + ".tmp", path)
+    return True
+
+class ScanReader:
+    """Random access to the complete records of a (possibly partial) scan."""
+    def __init__(self, scan_dir):
+        self.scan_dir = scan_dir
+        with open(os.path.join(scan_dir, META_FILE)) as f: self.meta = json.load(f)
+        self.params = self.meta.get("params", {})
+        h, w = self.meta["shape"]
+        index = _read_index(scan_dir)
+        data_path = os.path.join(scan_dir, DATA_FILE)
+        size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        n = min(len(index), size // (len(PLANES) * h * w * 4))
+        self.delays = [e[0] for e in index[:n]]
+        self.counts = [e[1] if len(e) > 1 else 0 for e in index[:n]]
+        self.data = np.memmap(data_path, np.float32, "r", shape=(n, len(PLANES), h, w)) if n else np.zeros((0, len(PLANES), h, w), np.float32)
+
+    def __len__(self):
+        return len(self.delays)
+
+    def __getitem__(self, i):
+        """(signal, background, variance) views of record i."""
+        rec = self.data[i]
+        return rec[0], rec[1], rec[2]
+
+    def by_delay(self, delay):
+        return self[self.delays.index(delay)]
+
+    def order(self):
+        """Record indices sorted by delay (records are stored in completion order)."""
+        return sorted(range(len(self)), key=lambda i: self.delays[i])
+
+def is_scan_store(scan_dir):
+    return os.path.exists(os.path.join(scan_dir, META_FILE))
+
+def to_u8(plane):
+    return np.clip(np.asarray(plane) + 0.5, 0, 255).astype(np.uint8)
+
+def export(scan_dir, out_dir=None, raw=True, frames=True, video=True, fps=None):
+    """Write the store back out as raw_bg/raw_sig/frame PNGs and an AVI."""
+    import processor
+    reader = ScanReader(scan_dir)
+    out_dir = out_dir or scan_dir
+    if not os.path.exists(out_dir): os.makedirs(out_dir)
+    p = reader.params
+    proc = processor.FrameProcessor()
+    ghost = (p.get("v_gx", 0), p.get("v_gy", 0), p.get("v_gamp", 0.0))
+    for i in reader.order():
+        d = reader.delays[i]
+        sig, bg, _ = reader[i]
+        s_gray, b_gray = to_u8(sig), to_u8(bg)
+        if raw:
+            processor.save_image(b_gray, out_dir, f"raw_bg_{d:05d}.png")
+            processor.save_image(s_gray, out_dir, f"raw_sig_{d:05d}.png")
+        if frames:
+            final = proc.process(s_gray, b_gray, p.get("v_gain_dig", 25.0), p.get("v_mode", "Enhanced"), ghost)
+            processor.save_image(final, out_dir, f"frame_{d:05d}.png")
+    if frames and video:
+        return processor.generate_video(out_dir, fps=fps or p.get("v_video_fps", 15))
+    return out_dir
@@ -0,0 +1,92 @@
+# videostream.py
+# Streaming video encoder for scans: processed frames are written as they are
+# produced, on a background thread, instead of re-reading frame_*.png from disk
+# after the sweep (processor.generate_video still rebuilds a video from disk).
+#   stream = VideoStream(os.path.join(scan_dir, "output_2d.avi"), fps=15, ffv1=True)
+#   stream.put(i, frame)   # any thread, any order; written in order of i
+#   stream.close()         # AVI (and .mkv) finalized
+import queue
+import shutil
+import subprocess
+import threading
+import cv2
+
+import config
+
+def ffmpeg_available():
+    return shutil.which("ffmpeg") is not None
+
+class VideoStream:
+    """Writes frames to an MJPG AVI in index order, and optionally the same
+    stream as lossless FFV1 through a local ffmpeg pipe.
+
+    put() may come from several workers out of order; a reorder buffer holds
+    frames until every lower index has been written or skip()ped. The queue to
+    the encoder thread is bounded, so a slow encoder backs up into the workers
+    instead of memory.
+    """
+    def __init__(self, path, fps, ffv1=False, depth=config.VIDEO_QUEUE_DEPTH):
+        self.path = path
+        self.fps = fps
+        self.ffv1_path = path.rsplit(".", 1)[0] + ".mkv" if ffv1 else None
+        if ffv1 and not ffmpeg_available():
+            print("ffmpeg not found, skipping the FFV1 encode"); self.ffv1_path = None
+        self.queue = queue.Queue(maxsize=depth)
+        self.pending = {}
+        self.next = 0
+        self.written = 0
+        self.video = None
+        self.ffmpeg = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, index, frame):
+        """Queues a BGR frame; the caller may reuse its buffer afterwards."""
+        self.queue.put((index, frame.copy()))
+
+    def skip(self, index):
+        """Marks an index that will never come (e.g. a delay with no frames)."""
+        self.queue.put((index, None))
+
+    def _open(self, frame):
+        h, w = frame.shape[:2]
+        self.video = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*'MJPG'), self.fps, (w, h))
+        if self.ffv1_path:
+            cmd = ["ffmpeg", "-y", "-loglevel", "error", "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{w}x{h}",
+                   "-r", str(self.fps), "-i", "-", "-c:v", "ffv1", self.ffv1_path]
+            try: self.ffmpeg = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+            except Exception as e: print(f"FFV1 Error: {e}"); self.ffv1_path = None
+
+    def _write(self, frame):
+        if frame is None: return
+        if frame.ndim == 2: frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        if self.video is None: self._open(frame)
+        self.video.write(frame)
+        if self.ffmpeg:
+            try: self.ffmpeg.stdin.write(frame.tobytes())
+            except Exception as e: print(f"FFV1 Error: {e}"); self.ffmpeg = None
+        self.written += 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            index, frame = item
+            self.pending[index] = frame
+            # Write every frame whose predecessors are all done
+            while self.next in self.pending:
+                try: self._write(self.pending.pop(self.next))
+                except Exception as e: print(f"Video Error: {e}")
+                self.next += 1
+        # Closing: whatever is left (gaps that were never skipped) goes out in order
+        for index in sorted(self.pending):
+            try: self._write(self.pending.pop(index))
+            except Exception as e: print(f"Video Error: {e}")
+
+    def close(self):
+        """Flushes and finalizes the files; returns the AVI path, or None if no frame was written."""
+        self.queue.put(None); self.thread.join()
+        if self.video is not None: self.video.release()
+        if self.ffmpeg:
+            self.ffmpeg.stdin.close(); self.ffmpeg.wait()
+        return self.path if self.written else None